@@ -0,0 +1,341 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark and load test for the touring API
+
+Runs main.py's app on a local threaded server against stand-ins for the
+external services: a fake transport.rest server (locations and departures,
+with configurable latency and error rate) and a fake Gemini model.  Scripted
+workloads then hit the API from concurrent clients and the throughput and
+p50/p95/p99 latency of every endpoint is reported.
+
+   python bench.py --workloads hot-stop,import --duration 10 --concurrency 16
+   python bench.py --json before.json
+   python bench.py --json after.json --compare before.json
+   python bench.py --app-dir ../baseline --json before.json
+
+--app-dir benchmarks the main.py of another checkout (e.g. a git worktree of an
+older commit), including trees from before create_app(): their module level app
+is patched in place.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import requests as rq
+from werkzeug.serving import make_server
+
+#main.py reads these when the app is created
+os.environ.setdefault('GOOGLE_API_KEY', 'benchmark')
+os.environ.setdefault('SLOW_REQUEST_MS', '600000')
+#the stand-in transport.rest has no rate limit to respect
+os.environ.setdefault('UPSTREAM_RATE', '0')
+
+first_stop_id = 9000000
+
+def stop_name(n):
+   return 'Bench Stop {n}'.format(n=n)
+
+class FakeBackend:
+   # latency/error settings shared by the fake transport.rest server and the fake Gemini model
+   def __init__(self, latency, jitter, error_rate, seed=0):
+      self.latency = latency
+      self.jitter = jitter
+      self.error_rate = error_rate
+      self.random = random.Random(seed)
+      self.lock = threading.Lock()
+      self.calls = 0
+
+   def wait(self):
+      # sleeps for one simulated round-trip, returns False when this call should fail
+      with self.lock:
+         self.calls += 1
+         delay = max(0.0, self.random.gauss(self.latency, self.jitter))
+         failed = self.random.random() < self.error_rate
+      time.sleep(delay)
+      return not failed
+
+def fake_transport_server(backend):
+   # locations?query=Bench Stop n returns stop n and its two neighbours, the departures
+   # of stop n head towards stop n+1 so /guide always finds a route
+   class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def send_json(self, code, body):
+         data = json.dumps(body).encode('utf-8')
+         self.send_response(code)
+         self.send_header('Content-Type', 'application/json')
+         self.send_header('Content-Length', str(len(data)))
+         self.end_headers()
+         self.wfile.write(data)
+
+      def do_GET(self):
+         url = urlparse(self.path)
+         args = parse_qs(url.query)
+         if not backend.wait():
+            return self.send_json(503, {'message': 'Service Unavailable'})
+
+         if url.path == '/locations':
+            query = args.get('query', [''])[0]
+            digits = ''.join(ch for ch in query if ch.isdigit())
+            n = int(digits) if digits else abs(hash(query)) % 100000
+            results = int(args.get('results', ['5'])[0])
+            locations = []
+            for i in range(n, n + min(results, 3)):
+               locations.append({'type': 'stop', 'id': str(first_stop_id + i), 'name': stop_name(i),
+                                 'location': {'latitude': 52.0 + (i % 1000) / 1000, 'longitude': 13.0 + (i // 1000) / 1000}})
+            return self.send_json(200, locations)
+
+         parts = url.path.strip('/').split('/')
+         if len(parts) == 3 and parts[0] == 'stops' and parts[2] == 'departures' and parts[1].isdigit():
+            n = int(parts[1]) - first_stop_id
+            departures = []
+            for i in range(int(args.get('results', ['5'])[0])):
+               departures.append({'platform': str(1 + i % 8),
+                                  'direction': stop_name(n + 1 + i),
+                                  'line': {'id': 're{i}'.format(i=i + 1), 'operator': {'name': 'Bench Operator {o}'.format(o=i % 3)}}})
+            return self.send_json(200, {'departures': departures})
+
+         return self.send_json(404, {'message': 'Not Found'})
+
+      def log_message(self, format, *args):
+         pass
+
+   server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+   server.daemon_threads = True
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   return server
+
+class FakeGemini:
+   # stands in for genai.GenerativeModel('gemini-pro')
+   class Answer:
+      def __init__(self, text):
+         self.text = text
+
+   def __init__(self, backend):
+      self.backend = backend
+
+   def generate_content(self, question, **kwargs):
+      if not self.backend.wait():
+         raise RuntimeError('fake Gemini failure')
+      return self.Answer('Benchmark answer to: {q}'.format(q=question))
+
+def start_api(args, transport_url, gemini_backend):
+   # older trees have no create_app(): a module level app, a db pool created at import (or before
+   # that a global connection opened by the __main__ block) and plain rq.get calls on api_url
+   sys.path.insert(0, os.path.abspath(args.app_dir))
+   import main
+
+   db_dir = tempfile.mkdtemp(prefix='bench-')
+   main.db_file = os.path.join(db_dir, 'bench.db')
+   if hasattr(main, 'create_app'):
+      app = main.create_app(start_refresher=False)
+   else:
+      app = main.app
+      #their /guide writes txt_file to the working directory and sends it from the app directory
+      main.txt_file = os.path.join(db_dir, 'bench.txt')
+      if hasattr(main, 'ConnectionPool'):
+         main.db_pool = main.ConnectionPool(main.db_file, main.db_pool_size)
+         main.init_db()
+      else:
+         main.con = sqlite3.connect(main.db_file, check_same_thread=False)
+         main.cur = main.con.cursor()
+         main.cur.execute('CREATE TABLE IF NOT EXISTS stops_table (stop_id,name,latitude,longitude,last_updated,self,prev,next,next_departure)')
+         main.cur.execute('CREATE TABLE IF NOT EXISTS gemini_cache (prompt_key TEXT PRIMARY KEY, prompt TEXT, response TEXT, created REAL, last_used REAL, hits INTEGER)')
+   if hasattr(main, 'UpstreamClient'):
+      main.upstream = main.UpstreamClient(transport_url)
+   else:
+      main.api_url = transport_url
+   main.gemini = FakeGemini(gemini_backend)
+   if not args.verbose:
+      getattr(main, 'logger', app.logger).setLevel(logging.CRITICAL)
+      logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+   if hasattr(main, 'PooledWSGIServer'):
+      #same server as `main.py serve`, in a single process
+      server = main.PooledWSGIServer('127.0.0.1', 0, app, main.serve_threads)
+      main.warm_up(app)
+   else:
+      #the global cursor of the oldest trees crashes sqlite3 when two threads use it, their requests are served one at a time
+      server = make_server('127.0.0.1', 0, app, threaded=hasattr(main, 'ConnectionPool'))
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   return main, server, 'http://127.0.0.1:{port}'.format(port=server.server_port)
+
+def seed(base, count):
+   # imports `count` stops and reads each once so that next_departure is filled in
+   names = [stop_name(i) for i in range(0, count, 3)]
+   session = rq.Session()
+   resp = session.post(base + '/stops/import', json={'names': names}, timeout=600)
+   if resp.status_code in (404, 405):
+      #no bulk import in this tree, one PUT per name
+      for name in names:
+         session.put(base + '/stops/query={name}'.format(name=name), timeout=60).raise_for_status()
+   else:
+      resp.raise_for_status()
+   for i in range(count):
+      session.get(base + '/stops/{id}'.format(id=first_stop_id + i), timeout=60)
+
+#workloads: name -> function(worker index, request number, stop count) returning (label, method, path, json body)
+def hot_stop(worker, n, stops):
+   #nine requests out of ten go to the same five stops
+   i = n % 5 if n % 10 else (worker * 7919 + n) % stops
+   return 'GET /stops/<id>', 'GET', '/stops/{id}'.format(id=first_stop_id + i), None
+
+def bulk_import(worker, n, stops):
+   i = 100000 + worker * 1000000 + n * 3
+   if n % 5:
+      return 'PUT /stops/<query>', 'PUT', '/stops/query={name}'.format(name=stop_name(i)), None
+   return 'POST /stops/import', 'POST', '/stops/import', {'names': [stop_name(i + 3 * k) for k in range(50)]}
+
+def guide(worker, n, stops):
+   return 'GET /guide', 'GET', '/guide', None
+
+def operator_profiles(worker, n, stops):
+   i = (worker + n) % stops
+   return 'GET /operator-profiles/<id>', 'GET', '/operator-profiles/{id}'.format(id=first_stop_id + i), None
+
+workloads = {
+   'hot-stop': hot_stop,
+   'import': bulk_import,
+   'guide': guide,
+   'profiles': operator_profiles,
+}
+
+def run_workload(base, workload, duration, concurrency, stops):
+   samples = []
+   lock = threading.Lock()
+   deadline = time.monotonic() + duration
+
+   def client(worker):
+      session = rq.Session()
+      n = 0
+      mine = []
+      while time.monotonic() < deadline:
+         label, method, path, body = workload(worker, n, stops)
+         started = time.perf_counter()
+         try:
+            status = session.request(method, base + path, json=body, timeout=120).status_code
+         except rq.RequestException:
+            status = 0
+         mine.append((label, time.perf_counter() - started, status))
+         n += 1
+      with lock:
+         samples.extend(mine)
+
+   started = time.monotonic()
+   threads = [threading.Thread(target=client, args=(w,)) for w in range(concurrency)]
+   for t in threads:
+      t.start()
+   for t in threads:
+      t.join()
+   return samples, time.monotonic() - started
+
+def summarize(workload_name, samples, elapsed):
+   result = []
+   for label in sorted({s[0] for s in samples}):
+      latencies = np.array([s[1] for s in samples if s[0] == label]) * 1000
+      statuses = [s[2] for s in samples if s[0] == label]
+      p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+      result.append({'workload': workload_name,
+                     'endpoint': label,
+                     'requests': len(latencies),
+                     #405: the endpoint doesn't exist in the tree under test, e.g. POST /stops/import before it was added
+                     'errors': sum(1 for code in statuses if code == 0 or code == 405 or code >= 500),
+                     'throughput': len(latencies) / elapsed,
+                     'p50_ms': float(p50),
+                     'p95_ms': float(p95),
+                     'p99_ms': float(p99)})
+   return result
+
+def git_commit(path):
+   try:
+      return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                            cwd=path).stdout.strip() or None
+   except OSError:
+      return None
+
+def print_report(results, baseline=None):
+   previous = {(r['workload'], r['endpoint']): r for r in (baseline or {}).get('results', [])}
+   header = '{:<10} {:<28} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format('workload', 'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+   print(header)
+   print('-' * len(header))
+   for r in results:
+      print('{:<10} {:<28} {:>8} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            r['workload'], r['endpoint'], r['requests'], r['errors'], r['throughput'], r['p50_ms'], r['p95_ms'], r['p99_ms']))
+      old = previous.get((r['workload'], r['endpoint']))
+      if old:
+         def change(key):
+            return '{:+.0f}%'.format((r[key] / old[key] - 1) * 100) if old[key] else 'n/a'
+         print('{:<10} {:<28} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+               '', '  vs ' + str(baseline.get('commit')), '', '', change('throughput'), change('p50_ms'), change('p95_ms'), change('p99_ms')))
+
+def main_cli(argv=None):
+   parser = argparse.ArgumentParser(description='Benchmark the touring API against local stand-ins for transport.rest and Gemini')
+   parser.add_argument('--workloads', default=','.join(workloads), help='comma separated, from: ' + ', '.join(workloads))
+   parser.add_argument('--duration', type=float, default=10, help='seconds each workload runs')
+   parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients per workload')
+   parser.add_argument('--stops', type=int, default=200, help='stops seeded before the workloads run')
+   parser.add_argument('--upstream-latency', type=float, default=0.05, help='mean transport.rest latency in seconds')
+   parser.add_argument('--upstream-jitter', type=float, default=0.02)
+   parser.add_argument('--upstream-error-rate', type=float, default=0.0, help='share of transport.rest calls answered with 503')
+   parser.add_argument('--gemini-latency', type=float, default=0.5, help='mean Gemini latency in seconds')
+   parser.add_argument('--gemini-jitter', type=float, default=0.2)
+   parser.add_argument('--gemini-error-rate', type=float, default=0.0)
+   parser.add_argument('--json', help='write the results to this file')
+   parser.add_argument('--compare', help='results file of an earlier run to compare against')
+   parser.add_argument('--verbose', action='store_true', help='keep the app and request logs')
+   parser.add_argument('--app-dir', default=os.path.dirname(os.path.abspath(__file__)),
+                       help='directory of the main.py to benchmark, e.g. a worktree of an older commit')
+   args = parser.parse_args(argv)
+
+   names = [w.strip() for w in args.workloads.split(',') if w.strip()]
+   unknown = [w for w in names if w not in workloads]
+   if unknown:
+      parser.error('unknown workload(s): ' + ', '.join(unknown))
+
+   transport_backend = FakeBackend(args.upstream_latency, args.upstream_jitter, args.upstream_error_rate, seed=1)
+   gemini_backend = FakeBackend(args.gemini_latency, args.gemini_jitter, args.gemini_error_rate, seed=2)
+   transport = fake_transport_server(transport_backend)
+   app_module, server, base = start_api(args, 'http://127.0.0.1:{port}/'.format(port=transport.server_port), gemini_backend)
+
+   print('seeding {n} stops ...'.format(n=args.stops), file=sys.stderr)
+   seed(base, args.stops)
+
+   results = []
+   for name in names:
+      print('running {w} for {d}s with {c} clients ...'.format(w=name, d=args.duration, c=args.concurrency), file=sys.stderr)
+      samples, elapsed = run_workload(base, workloads[name], args.duration, args.concurrency, args.stops)
+      results.extend(summarize(name, samples, elapsed))
+
+   server.shutdown()
+   transport.shutdown()
+
+   baseline = None
+   if args.compare:
+      with open(args.compare) as f:
+         baseline = json.load(f)
+   print_report(results, baseline)
+
+   if args.json:
+      report = {'commit': git_commit(args.app_dir),
+                'settings': {k: v for k, v in vars(args).items() if k not in ('json', 'compare', 'verbose', 'app_dir')},
+                'upstream_calls': {'transport.rest': transport_backend.calls, 'gemini': gemini_backend.calls},
+                'results': results}
+      with open(args.json, 'w') as f:
+         json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+   main_cli()
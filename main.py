@@ -19,19 +19,56 @@ from pathlib import Path
 from dotenv import load_dotenv          # Needed to load the environment variables from the .env file
 import google.generativeai as genai     # Needed to access the Generative AI API
 
-from flask import Flask, request, send_file
+from flask import Flask, Response, g, has_app_context, request
 from flask_restx import Resource, Api, fields
+from flask_restx.representations import output_json
+import numpy as np
+import pandas as pd
 import requests as rq
+from requests.adapters import HTTPAdapter
+from werkzeug.http import http_date, quote_etag
+try:
+   import pyarrow as pa                 # optional, only needed by the parquet and arrow exports
+   import pyarrow.parquet as pq
+except ImportError:
+   pa = pq = None
+try:
+   import fcntl                         # POSIX only, elects the process that runs the departure refresher
+except ImportError:
+   fcntl = None
+from werkzeug.serving import BaseWSGIServer
+import argparse
+import hashlib
+import json
+import logging
+import queue
+import re
+import signal
+import socket
 import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeout
 from datetime import datetime
+from urllib.parse import urlencode
+
+# Load the environment variables from the .env file
+load_dotenv()
 
 studentid = Path(__file__).stem         # Will capture your zID from the filename.
 db_file   = f"{studentid}.db"           # Use this variable when referencing the SQLite database file.
 txt_file  = f"{studentid}.txt"          # Use this variable when referencing the txt file for Q7.
 
-app = Flask(__name__)
-api = Api(app,
-          default = 'Stops',
+logger    = logging.getLogger(__name__)
+
+#the app itself is built per process by create_app()
+api = Api(default = 'Stops',
           title = 'Touring API with stops stroing DB',
           description  = 'Retrieve stop info through Deutsche Bahn API and Touring info through Gemini API')
 
@@ -48,9 +85,1686 @@ stops_model = api.model('Stops', {
     'next_departure':fields.String
 })
 
+#request instrumentation, exposed in Prometheus text format on /metrics
+slow_request_ms = float(os.environ.get('SLOW_REQUEST_MS', 1000))    # requests slower than this are logged with their phases
+
+class MetricsRegistry:
+   # histograms keyed by (name, labels), kept per process. Latency buckets in seconds unless
+   # describe() gave the metric buckets of its own
+   buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.histograms = {}
+      self.descriptions = {}
+      self.metric_buckets = {}
+
+   def describe(self, name, description, buckets=None):
+      self.descriptions[name] = description
+      if buckets is not None:
+         self.metric_buckets[name] = tuple(buckets)
+
+   def observe(self, name, value, **labels):
+      key = (name, tuple(sorted(labels.items())))
+      buckets = self.metric_buckets.get(name, self.buckets)
+      with self.lock:
+         h = self.histograms.get(key)
+         if h is None:
+            h = self.histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+         h[0][bisect_left(buckets, value)] += 1
+         h[1] += value
+         h[2] += 1
+
+   @staticmethod
+   def format_labels(labels):
+      if not labels:
+         return ''
+      return '{' + ','.join('{k}="{v}"'.format(k=k, v=str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+   def render(self, gauges=()):
+      # gauges are (name, labels dict, value) computed at scrape time
+      lines = []
+      with self.lock:
+         histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self.histograms.items())
+      typed = set()
+      for (name, labels), (counts, total, count) in histograms:
+         if name not in typed:
+            typed.add(name)
+            lines.append('# HELP {n} {d}'.format(n=name, d=self.descriptions.get(name, name)))
+            lines.append('# TYPE {n} histogram'.format(n=name))
+         cumulative = 0
+         for bound, n in zip(self.metric_buckets.get(name, self.buckets) + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('{n}_bucket{l} {c}'.format(n=name, l=self.format_labels(labels + (('le', le),)), c=cumulative))
+         lines.append('{n}_sum{l} {v}'.format(n=name, l=self.format_labels(labels), v=total))
+         lines.append('{n}_count{l} {v}'.format(n=name, l=self.format_labels(labels), v=count))
+      for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+         if name not in typed:
+            typed.add(name)
+            lines.append('# HELP {n} {d}'.format(n=name, d=self.descriptions.get(name, name)))
+            lines.append('# TYPE {n} gauge'.format(n=name))
+         lines.append('{n}{l} {v}'.format(n=name, l=self.format_labels(tuple(sorted(labels.items()))), v=value))
+      return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.describe('http_request_duration_seconds', 'Time spent handling a request, by endpoint')
+metrics.describe('upstream_request_duration_seconds', 'Time spent in calls to external services, by target')
+metrics.describe('upstream_limiter_wait_seconds', 'Time spent queued for a transport.rest rate limit token, by priority')
+metrics.describe('sqlite_query_duration_seconds', 'Time spent executing SQLite statements')
+metrics.describe('sqlite_queries_per_request', 'SQLite statements executed while handling one request', buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+metrics.describe('cache_hit_ratio', 'Share of lookups answered from cache')
+metrics.describe('cache_entries', 'Entries currently held by a cache')
+metrics.describe('worker_info', 'Process that answered this scrape, every other metric is counted by this process only')
+
+def record_phase(phase, seconds):
+   # adds to the per-phase breakdown of the current request, if there is one
+   if has_app_context() and 'phases' in g:
+      g.phases[phase] += seconds
+
+def record_query(seconds):
+   metrics.observe('sqlite_query_duration_seconds', seconds)
+   if has_app_context() and 'phases' in g:
+      g.phases['sqlite'] += seconds
+      g.queries += 1
+
+class InstrumentedCursor(sqlite3.Cursor):
+   def execute(self, *args):
+      started = time.perf_counter()
+      try:
+         return super().execute(*args)
+      finally:
+         record_query(time.perf_counter() - started)
+
+   def executemany(self, *args):
+      started = time.perf_counter()
+      try:
+         return super().executemany(*args)
+      finally:
+         record_query(time.perf_counter() - started)
+
+class InstrumentedConnection(sqlite3.Connection):
+   # times every statement, Connection.execute does not go through cursor() so both are wrapped
+   def cursor(self, factory=InstrumentedCursor):
+      return super().cursor(factory)
+
+   def execute(self, *args):
+      started = time.perf_counter()
+      try:
+         return super().execute(*args)
+      finally:
+         record_query(time.perf_counter() - started)
+
+   def executemany(self, *args):
+      started = time.perf_counter()
+      try:
+         return super().executemany(*args)
+      finally:
+         record_query(time.perf_counter() - started)
+
+def start_request_timer():
+   g.started = time.perf_counter()
+   g.phases = defaultdict(float)
+   g.queries = 0
+
+def record_request(response):
+   if 'started' not in g:
+      return response
+   elapsed = time.perf_counter() - g.started
+   endpoint = request.endpoint or 'unmatched'
+   metrics.observe('http_request_duration_seconds', elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+   metrics.observe('sqlite_queries_per_request', g.queries, endpoint=endpoint)
+   if elapsed * 1000 >= slow_request_ms:
+      phases = ', '.join('{p}={ms:.1f}ms'.format(p=p, ms=s * 1000) for p, s in sorted(g.phases.items()))
+      logger.warning('slow request %s %s -> %s in %.1fms (%d queries; %s)',
+                         request.method, request.full_path, response.status_code, elapsed * 1000, g.queries, phases or 'no phases')
+   return response
+
+@api.representation('application/json')
+def output_json_timed(data, code, headers=None):
+   started = time.perf_counter()
+   resp = output_json(data, code, headers)
+   record_phase('serialize', time.perf_counter() - started)
+   return resp
+
+#sqlite settings, can be tuned from the .env file
+db_pool_size    = int(os.environ.get('DB_POOL_SIZE', 16))                   # connections shared by request and worker threads
+db_busy_timeout = float(os.environ.get('DB_BUSY_TIMEOUT', 5))               # seconds a writer waits for the write lock
+db_pool_timeout = float(os.environ.get('DB_POOL_TIMEOUT', 10))              # seconds a thread waits for a free connection
+db_cache_size   = int(os.environ.get('DB_CACHE_SIZE', -16000))              # page cache per connection, negative means KiB
+db_mmap_size    = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))    # bytes of the db file read through mmap
+
+#versioned schema migrations, PRAGMA user_version holds the number of scripts applied
+migrations = [
+   # 1: typed stops_table, rows of the untyped table created by earlier versions are carried over
+   '''
+   CREATE TABLE IF NOT EXISTS stops_table (stop_id,name,latitude,longitude,last_updated,self,prev,next,next_departure);
+   ALTER TABLE stops_table RENAME TO stops_table_untyped;
+   CREATE TABLE stops_table (
+      stop_id        INTEGER PRIMARY KEY,
+      name           TEXT,
+      latitude       REAL,
+      longitude      REAL,
+      last_updated   TEXT,
+      self           TEXT,
+      prev           TEXT,
+      next           TEXT,
+      next_departure TEXT
+   );
+   INSERT OR REPLACE INTO stops_table
+      SELECT CAST(stop_id AS INTEGER), name, latitude, longitude, last_updated, self, prev, next, next_departure
+      FROM stops_table_untyped;
+   DROP TABLE stops_table_untyped;
+   ''',
+   # 2: cache of Gemini answers
+   '''
+   CREATE TABLE IF NOT EXISTS gemini_cache (
+      prompt_key TEXT PRIMARY KEY,
+      prompt     TEXT,
+      response   TEXT,
+      created    REAL,
+      last_used  REAL,
+      hits       INTEGER
+   );
+   CREATE INDEX IF NOT EXISTS gemini_cache_last_used ON gemini_cache (last_used);
+   ''',
+   # 3: prev/next are derived from the stop_id index on read, the stored copies went stale on delete
+   '''
+   ALTER TABLE stops_table DROP COLUMN prev;
+   ALTER TABLE stops_table DROP COLUMN next;
+   ''',
+   # 4: unix time next_departure was last fetched, lets GETs serve the background refreshed value
+   '''
+   ALTER TABLE stops_table ADD COLUMN departure_refreshed REAL;
+   ''',
+   # 5: R*Tree over latitude/longitude, kept in step with stops_table by triggers
+   '''
+   CREATE VIRTUAL TABLE stops_rtree USING rtree(stop_id, min_lat, max_lat, min_lon, max_lon);
+   INSERT INTO stops_rtree
+      SELECT stop_id, latitude, latitude, longitude, longitude FROM stops_table
+      WHERE latitude IS NOT NULL AND longitude IS NOT NULL;
+   CREATE TRIGGER stops_rtree_insert AFTER INSERT ON stops_table
+      WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL
+   BEGIN
+      INSERT INTO stops_rtree VALUES (new.stop_id, new.latitude, new.latitude, new.longitude, new.longitude);
+   END;
+   CREATE TRIGGER stops_rtree_update AFTER UPDATE OF latitude, longitude ON stops_table
+   BEGIN
+      DELETE FROM stops_rtree WHERE stop_id = old.stop_id;
+      INSERT INTO stops_rtree
+         SELECT new.stop_id, new.latitude, new.latitude, new.longitude, new.longitude
+         WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+   END;
+   CREATE TRIGGER stops_rtree_delete AFTER DELETE ON stops_table
+   BEGIN
+      DELETE FROM stops_rtree WHERE stop_id = old.stop_id;
+   END;
+   ''',
+   # 6: full text index over next_departure, used to find which stored stops lead to which
+   '''
+   CREATE VIRTUAL TABLE departure_fts USING fts5(next_departure, content='stops_table', content_rowid='stop_id');
+   INSERT INTO departure_fts(departure_fts) VALUES ('rebuild');
+   CREATE TRIGGER departure_fts_insert AFTER INSERT ON stops_table
+   BEGIN
+      INSERT INTO departure_fts(rowid, next_departure) VALUES (new.stop_id, new.next_departure);
+   END;
+   CREATE TRIGGER departure_fts_update AFTER UPDATE OF next_departure ON stops_table
+      WHEN old.next_departure IS NOT new.next_departure
+   BEGIN
+      INSERT INTO departure_fts(departure_fts, rowid, next_departure) VALUES ('delete', old.stop_id, old.next_departure);
+      INSERT INTO departure_fts(rowid, next_departure) VALUES (new.stop_id, new.next_departure);
+   END;
+   CREATE TRIGGER departure_fts_delete AFTER DELETE ON stops_table
+   BEGIN
+      INSERT INTO departure_fts(departure_fts, rowid, next_departure) VALUES ('delete', old.stop_id, old.next_departure);
+   END;
+   ''',
+   # 7: complete /guide downloads, addressed by a hash of their source and destination
+   '''
+   CREATE TABLE guide_cache (
+      guide_key   TEXT PRIMARY KEY,
+      source      TEXT,
+      destination TEXT,
+      body        TEXT,
+      created     REAL,
+      last_used   REAL,
+      hits        INTEGER
+   );
+   CREATE INDEX guide_cache_last_used ON guide_cache (last_used);
+   ''',
+   # 8: last_updated as unix time (it is written in local time) for range scans and age statistics,
+   #    and the operator of next_departure
+   '''
+   ALTER TABLE stops_table ADD COLUMN last_updated_ts INTEGER;
+   ALTER TABLE stops_table ADD COLUMN next_operator TEXT;
+   UPDATE stops_table SET last_updated_ts = CAST(strftime('%s', substr(last_updated, 1, 10) || ' ' || substr(last_updated, 12), 'utc') AS INTEGER);
+   CREATE INDEX stops_last_updated_ts ON stops_table (last_updated_ts);
+   CREATE TRIGGER stops_last_updated_ts_insert AFTER INSERT ON stops_table
+   BEGIN
+      UPDATE stops_table SET last_updated_ts = CAST(strftime('%s', substr(new.last_updated, 1, 10) || ' ' || substr(new.last_updated, 12), 'utc') AS INTEGER) WHERE stop_id = new.stop_id;
+   END;
+   CREATE TRIGGER stops_last_updated_ts_update AFTER UPDATE OF last_updated ON stops_table
+      WHEN old.last_updated IS NOT new.last_updated
+   BEGIN
+      UPDATE stops_table SET last_updated_ts = CAST(strftime('%s', substr(new.last_updated, 1, 10) || ' ' || substr(new.last_updated, 12), 'utc') AS INTEGER) WHERE stop_id = new.stop_id;
+   END;
+   ''',
+   # 9: the "towards X" part of next_departure in its own indexed column, so /guide routes are an
+   #    equi-join on name instead of one full text match per stop. It replaces departure_fts
+   '''
+   DROP TRIGGER departure_fts_insert;
+   DROP TRIGGER departure_fts_update;
+   DROP TRIGGER departure_fts_delete;
+   DROP TABLE departure_fts;
+   ALTER TABLE stops_table ADD COLUMN next_destination TEXT;
+   UPDATE stops_table SET next_destination = CASE WHEN instr(next_departure, ' towards ') > 0 THEN substr(next_departure, instr(next_departure, ' towards ') + 9) END;
+   CREATE INDEX stops_next_destination ON stops_table (next_destination);
+   CREATE TRIGGER stops_next_destination_insert AFTER INSERT ON stops_table
+      WHEN new.next_departure IS NOT NULL
+   BEGIN
+      UPDATE stops_table SET next_destination = CASE WHEN instr(new.next_departure, ' towards ') > 0 THEN substr(new.next_departure, instr(new.next_departure, ' towards ') + 9) END WHERE stop_id = new.stop_id;
+   END;
+   CREATE TRIGGER stops_next_destination_update AFTER UPDATE OF next_departure ON stops_table
+      WHEN old.next_departure IS NOT new.next_departure
+   BEGIN
+      UPDATE stops_table SET next_destination = CASE WHEN instr(new.next_departure, ' towards ') > 0 THEN substr(new.next_departure, instr(new.next_departure, ' towards ') + 9) END WHERE stop_id = new.stop_id;
+   END;
+   ''',
+   # 10: a per-row version that every change of a GET /stops/<id> body bumps, so each worker can check
+   #     its cached bodies against the database. Inserts and deletes change the prev/next links of the neighbours
+   '''
+   ALTER TABLE stops_table ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+   CREATE TRIGGER stops_version_update AFTER UPDATE OF name, latitude, longitude, last_updated, next_departure ON stops_table
+   BEGIN
+      UPDATE stops_table SET version = version + 1 WHERE stop_id = new.stop_id;
+   END;
+   CREATE TRIGGER stops_version_insert AFTER INSERT ON stops_table
+   BEGIN
+      UPDATE stops_table SET version = version + 1
+      WHERE stop_id IN ((SELECT max(stop_id) FROM stops_table WHERE stop_id < new.stop_id),
+                        (SELECT min(stop_id) FROM stops_table WHERE stop_id > new.stop_id));
+   END;
+   CREATE TRIGGER stops_version_delete AFTER DELETE ON stops_table
+   BEGIN
+      UPDATE stops_table SET version = version + 1
+      WHERE stop_id IN ((SELECT max(stop_id) FROM stops_table WHERE stop_id < old.stop_id),
+                        (SELECT min(stop_id) FROM stops_table WHERE stop_id > old.stop_id));
+   END;
+   ''',
+   # 11: when each stop was last requested, written by every worker so the one running the refresher sees them all
+   '''
+   ALTER TABLE stops_table ADD COLUMN last_requested REAL;
+   CREATE INDEX stops_refresh_order ON stops_table (last_requested DESC, departure_refreshed);
+   ''',
+   # 12: a next_departure without " towards " is a destination as a whole, so client-written departures route too
+   '''
+   DROP TRIGGER stops_next_destination_insert;
+   DROP TRIGGER stops_next_destination_update;
+   UPDATE stops_table SET next_destination = next_departure WHERE next_destination IS NULL;
+   CREATE TRIGGER stops_next_destination_insert AFTER INSERT ON stops_table
+      WHEN new.next_departure IS NOT NULL
+   BEGIN
+      UPDATE stops_table SET next_destination = CASE WHEN instr(new.next_departure, ' towards ') > 0 THEN substr(new.next_departure, instr(new.next_departure, ' towards ') + 9) ELSE new.next_departure END WHERE stop_id = new.stop_id;
+   END;
+   CREATE TRIGGER stops_next_destination_update AFTER UPDATE OF next_departure ON stops_table
+      WHEN old.next_departure IS NOT new.next_departure
+   BEGIN
+      UPDATE stops_table SET next_destination = CASE WHEN instr(new.next_departure, ' towards ') > 0 THEN substr(new.next_departure, instr(new.next_departure, ' towards ') + 9) ELSE new.next_departure END WHERE stop_id = new.stop_id;
+   END;
+   ''',
+]
+
+
+def open_connection(path):
+   conn = sqlite3.connect(path, timeout=db_busy_timeout, check_same_thread=False, factory=InstrumentedConnection)
+   conn.row_factory = sqlite3.Row
+   conn.execute('PRAGMA journal_mode = WAL')
+   conn.execute('PRAGMA synchronous = NORMAL')
+   conn.execute('PRAGMA cache_size = {n}'.format(n=db_cache_size))
+   conn.execute('PRAGMA mmap_size = {n}'.format(n=db_mmap_size))
+   conn.execute('PRAGMA temp_store = MEMORY')
+   return conn
+
+class DatabaseBusy(Exception):
+   pass
+
+class ConnectionPool:
+   # hands each thread its own connection for the duration of a request or job,
+   # so WAL readers run next to the single writer instead of sharing one cursor.
+   # A thread should hold one connection at a time, inside a request that is get_db()'s
+   def __init__(self, path, size, timeout=db_pool_timeout):
+      self.path = path
+      self.size = size
+      self.timeout = timeout
+      self.idle = queue.LifoQueue()
+      self.created = 0
+      self.lock = threading.Lock()
+
+   def acquire(self):
+      try:
+         return self.idle.get_nowait()
+      except queue.Empty:
+         pass
+      with self.lock:
+         if self.created < self.size:
+            self.created += 1
+            return open_connection(self.path)
+      try:
+         return self.idle.get(timeout=self.timeout)
+      except queue.Empty:
+         raise DatabaseBusy('no free connection to {p} after {t}s'.format(p=self.path, t=self.timeout)) from None
+
+   def release(self, conn):
+      if conn.in_transaction:
+         conn.rollback()
+      self.idle.put(conn)
+
+   @contextmanager
+   def connection(self):
+      conn = self.acquire()
+      try:
+         yield conn
+      finally:
+         self.release(conn)
+
+   def close_all(self):
+      while True:
+         try:
+            self.idle.get_nowait().close()
+         except queue.Empty:
+            break
+      with self.lock:
+         self.created = 0
+
+db_pool = None     # ConnectionPool of this process, created by create_app()
+
+def migrate(conn):
+   version = conn.execute('PRAGMA user_version').fetchone()[0]
+   for number, script in enumerate(migrations[version:], start=version + 1):
+      try:
+         conn.executescript('BEGIN;' + script + 'PRAGMA user_version = {n}; COMMIT;'.format(n=number))
+      except sqlite3.Error:
+         if conn.in_transaction:
+            conn.rollback()
+         raise
+
+def init_db():
+   with db_pool.connection() as conn:
+      migrate(conn)
+
+def get_db():
+   # connection of the current request, given back to the pool when the app context ends
+   if 'db' not in g:
+      g.db = db_pool.acquire()
+   return g.db
+
+def release_db(exception):
+   conn = g.pop('db', None)
+   if conn is not None:
+      db_pool.release(conn)
+
+@contextmanager
+def db_connection():
+   # the request's own connection inside a request, a pooled one elsewhere (worker threads, streamed
+   # responses). Taking a second pooled connection inside a request can deadlock a full pool
+   if has_app_context():
+      yield get_db()
+   else:
+      with db_pool.connection() as conn:
+         yield conn
+
+@api.errorhandler(DatabaseBusy)
+def handle_database_busy(error):
+   return {'message': 'Service is busy at the time, please try again.'}, 503
+
 #external DB Api
 api_url = 'https://v6.db.transport.rest/'
 
+#upstream client settings, can be tuned from the .env file
+upstream_pool_size       = int(os.environ.get('UPSTREAM_POOL_SIZE', 20))           # keep-alive connections kept per host
+upstream_connect_timeout = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+upstream_read_timeout    = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 10))
+upstream_retries         = int(os.environ.get('UPSTREAM_RETRIES', 2))              # retries on 503 / connection errors
+upstream_backoff         = float(os.environ.get('UPSTREAM_BACKOFF', 0.5))          # backoff factor between retries
+breaker_threshold        = int(os.environ.get('UPSTREAM_BREAKER_THRESHOLD', 5))    # consecutive failures that open the circuit
+breaker_cooldown         = float(os.environ.get('UPSTREAM_BREAKER_COOLDOWN', 30))  # seconds before a trial call is let through
+
+class UpstreamUnavailable(Exception):
+   pass
+
+#upstream rate limit, can be tuned from the .env file. v6.db.transport.rest allows about 100 requests a minute
+upstream_rate  = float(os.environ.get('UPSTREAM_RATE', 100 / 60))   # requests per second shared by all callers of a process, 0 turns the limit off
+upstream_burst = float(os.environ.get('UPSTREAM_BURST', 10))         # requests that can go out at once after an idle period
+#seconds a caller of each priority class queues for a token before giving up, highest priority first
+upstream_waits = {'interactive': float(os.environ.get('UPSTREAM_WAIT_INTERACTIVE', 2)),
+                  'refresh':     float(os.environ.get('UPSTREAM_WAIT_REFRESH', 5)),
+                  'bulk':        float(os.environ.get('UPSTREAM_WAIT_BULK', 30))}
+
+class UpstreamThrottled(UpstreamUnavailable):
+   pass
+
+class TokenBucket:
+   # token bucket with priority classes: a caller only takes a token when no caller of a higher class
+   # is queued, and gives up when its deadline passes. A 429 from upstream empties the bucket for Retry-After
+   def __init__(self, rate, burst, waits):
+      self.rate = rate
+      self.burst = burst
+      self.waits = waits
+      self.priorities = tuple(waits)
+      self.tokens = burst
+      self.updated = time.monotonic()
+      self.cond = threading.Condition()
+      self.waiting = dict.fromkeys(self.priorities, 0)
+      self.granted = dict.fromkeys(self.priorities, 0)
+      self.rejected = dict.fromkeys(self.priorities, 0)
+      self.throttled = 0
+
+   def refill(self, now):
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+
+   def acquire(self, priority):
+      if self.rate <= 0:
+         return True
+      started = time.monotonic()
+      deadline = started + self.waits[priority]
+      higher = self.priorities[:self.priorities.index(priority)]
+      outcome = 'error'
+      with self.cond:
+         self.waiting[priority] += 1
+         try:
+            while True:
+               now = time.monotonic()
+               self.refill(now)
+               if self.tokens >= 1 and not any(self.waiting[p] for p in higher):
+                  self.tokens -= 1
+                  self.granted[priority] += 1
+                  outcome = 'granted'
+                  return True
+               if now >= deadline:
+                  self.rejected[priority] += 1
+                  outcome = 'rejected'
+                  return False
+               self.cond.wait(min(deadline - now, max((1 - self.tokens) / self.rate, 0.01)))
+         finally:
+            self.waiting[priority] -= 1
+            self.cond.notify_all()
+            metrics.observe('upstream_limiter_wait_seconds', time.monotonic() - started, priority=priority, outcome=outcome)
+
+   def penalize(self, retry_after):
+      # upstream said 429, nobody gets a token for retry_after seconds
+      with self.cond:
+         self.refill(time.monotonic())
+         self.tokens = min(self.tokens, 0) - retry_after * self.rate
+         self.throttled += 1
+
+   def stats(self):
+      with self.cond:
+         self.refill(time.monotonic())
+         return {'rate': self.rate,
+                 'burst': self.burst,
+                 'tokens': round(self.tokens, 2),
+                 'waits': self.waits,
+                 'waiting': dict(self.waiting),
+                 'granted': dict(self.granted),
+                 'rejected': dict(self.rejected),
+                 'upstream_429': self.throttled}
+
+class CircuitBreaker:
+   # closed -> open after `threshold` consecutive failures, half_open after `cooldown`
+   # seconds, where a single trial call decides whether to close or re-open.
+   def __init__(self, threshold, cooldown):
+      self.threshold = threshold
+      self.cooldown = cooldown
+      self.state = 'closed'
+      self.failures = 0
+      self.opened_at = 0.0
+      self.trial_running = False
+      self.rejected = 0
+      self.lock = threading.Lock()
+
+   def allow(self):
+      with self.lock:
+         if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+            self.trial_running = False
+         if self.state == 'closed':
+            return True
+         if self.state == 'half_open' and not self.trial_running:
+            self.trial_running = True
+            return True
+         self.rejected += 1
+         return False
+
+   def record_success(self):
+      with self.lock:
+         self.state = 'closed'
+         self.failures = 0
+         self.trial_running = False
+
+   def record_failure(self):
+      with self.lock:
+         self.failures += 1
+         self.trial_running = False
+         if self.state == 'half_open' or self.failures >= self.threshold:
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+   def stats(self):
+      with self.lock:
+         return {'state': self.state,
+                 'consecutive_failures': self.failures,
+                 'rejected': self.rejected,
+                 'threshold': self.threshold,
+                 'cooldown': self.cooldown}
+
+class UpstreamClient:
+   # one keep-alive session shared by every handler, so connections to api_url are reused.
+   # rate is this process' share of the upstream rate limit
+   def __init__(self, base_url, rate=upstream_rate):
+      self.base_url = base_url
+      self.timeout = (upstream_connect_timeout, upstream_read_timeout)
+      self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+      self.limiter = TokenBucket(rate, upstream_burst, upstream_waits)
+      #retries are made by get(), so that each of them takes a token from the limiter
+      adapter = HTTPAdapter(pool_connections=1, pool_maxsize=upstream_pool_size, max_retries=0)
+      self.session = rq.Session()
+      self.session.mount(base_url, adapter)
+
+   def get(self, path, params=None, priority='interactive'):
+      #the token comes first: a half open breaker hands out its single trial call in allow(),
+      #and that call has to reach upstream to close or re-open the circuit
+      if not self.limiter.acquire(priority):
+         raise UpstreamThrottled('no {p} request budget left for {url}'.format(p=priority, url=self.base_url))
+      if not self.breaker.allow():
+         raise UpstreamUnavailable('circuit open for {url}'.format(url=self.base_url))
+      attempt = 0
+      while True:
+         started = time.perf_counter()
+         try:
+            resp = self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+         except rq.RequestException as e:
+            metrics.observe('upstream_request_duration_seconds', time.perf_counter() - started, target='transport.rest', outcome='error')
+            if isinstance(e, rq.ConnectionError) and self.retry(attempt, priority):
+               attempt += 1
+               continue
+            self.breaker.record_failure()
+            raise UpstreamUnavailable(str(e)) from e
+         elapsed = time.perf_counter() - started
+         metrics.observe('upstream_request_duration_seconds', elapsed, target='transport.rest', outcome=str(resp.status_code))
+         record_phase('transport.rest', elapsed)
+         if resp.status_code == 503 and self.retry(attempt, priority):
+            attempt += 1
+            continue
+         break
+      if resp.status_code == 429:
+         try:
+            retry_after = float(resp.headers.get('Retry-After', 1))
+         except ValueError:
+            retry_after = 1.0
+         self.limiter.penalize(retry_after)
+      if resp.status_code >= 500:
+         self.breaker.record_failure()
+      else:
+         self.breaker.record_success()
+      return resp
+
+   def retry(self, attempt, priority):
+      # backs off before one more attempt on 503 or a connection error, False once the retries
+      # or the request budget of this priority are used up
+      if attempt >= upstream_retries:
+         return False
+      time.sleep(upstream_backoff * 2 ** attempt)
+      return self.limiter.acquire(priority)
+
+   def stats(self):
+      return {'base_url': self.base_url,
+              'pool_size': upstream_pool_size,
+              'timeout': {'connect': self.timeout[0], 'read': self.timeout[1]},
+              'retries': upstream_retries,
+              'circuit': self.breaker.stats(),
+              'rate_limit': self.limiter.stats()}
+
+upstream = None    # UpstreamClient of this process, created by create_app()
+
+@api.errorhandler(UpstreamUnavailable)
+def handle_upstream_unavailable(error):
+   return {'message': 'Service is not avalaible at the time.'}, 503
+
+#departure cache settings, can be tuned from the .env file
+departure_cache_ttl  = float(os.environ.get('DEPARTURE_CACHE_TTL', 30))     # seconds a departure board is served from cache
+departure_cache_size = int(os.environ.get('DEPARTURE_CACHE_SIZE', 1024))    # max (stop_id, duration, results) keys kept
+departure_stale_ttl  = float(os.environ.get('DEPARTURE_STALE_TTL', 600))    # seconds past the ttl a board is still served when upstream can't be reached
+
+class DepartureCache:
+   # TTL + LRU cache for departure boards, keyed by (stop_id, duration, results).
+   # Concurrent misses on the same key wait on the single in-flight upstream call.
+   # Expired boards are kept for stale_ttl more seconds and served when the reload fails
+   def __init__(self, ttl, maxsize, stale_ttl):
+      self.ttl = ttl
+      self.maxsize = maxsize
+      self.stale_ttl = stale_ttl
+      self.entries = OrderedDict()
+      self.inflight = {}
+      self.lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+      self.coalesced = 0
+      self.evictions = 0
+      self.expirations = 0
+      self.stale_served = 0
+
+   def get(self, key, loader):
+      # returns (value, age in seconds of value)
+      leader = False
+      with self.lock:
+         now = time.monotonic()
+         entry = self.entries.get(key)
+         if entry is not None:
+            if entry[0] > now:
+               self.entries.move_to_end(key)
+               self.hits += 1
+               return entry[1], now - entry[2]
+            if entry[0] + self.stale_ttl <= now:
+               del self.entries[key]
+               self.expirations += 1
+               entry = None
+         call = self.inflight.get(key)
+         if call is None:
+            call = self.inflight[key] = Future()
+            self.misses += 1
+            leader = True
+         else:
+            self.coalesced += 1
+
+      if not leader:
+         return call.result()
+
+      try:
+         value = loader()
+      except UpstreamUnavailable as e:
+         if entry is None:
+            with self.lock:
+               del self.inflight[key]
+            call.set_exception(e)
+            raise
+         value = None
+      except BaseException as e:
+         with self.lock:
+            del self.inflight[key]
+         call.set_exception(e)
+         raise
+
+      with self.lock:
+         del self.inflight[key]
+         now = time.monotonic()
+         #only successful boards are cached, errors are retried on the next request
+         if value is not None and value[0] == 200:
+            self.entries[key] = (now + self.ttl, value, now)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+               self.entries.popitem(last=False)
+               self.evictions += 1
+            result = (value, 0.0)
+         elif entry is not None and (value is None or value[0] == 429 or value[0] >= 500):
+            self.stale_served += 1
+            result = (entry[1], now - entry[2])
+         else:
+            result = (value, 0.0)
+      call.set_result(result)
+      return result
+
+   def clear(self):
+      with self.lock:
+         self.entries.clear()
+
+   def stats(self):
+      with self.lock:
+         lookups = self.hits + self.misses + self.coalesced
+         return {'ttl': self.ttl,
+                 'stale_ttl': self.stale_ttl,
+                 'maxsize': self.maxsize,
+                 'size': len(self.entries),
+                 'inflight': len(self.inflight),
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'coalesced': self.coalesced,
+                 'evictions': self.evictions,
+                 'expirations': self.expirations,
+                 'stale_served': self.stale_served,
+                 'hit_ratio': (self.hits + self.coalesced) / lookups if lookups else 0.0}
+
+departure_cache = DepartureCache(departure_cache_ttl, departure_cache_size, departure_stale_ttl)
+
+def get_departures(id, duration, results=None, priority='interactive'):
+   # returns (status_code, json body, age in seconds) of the departures board, served from departure_cache
+   # when fresh, and from its stale copy when upstream fails or the request budget is used up
+   def load():
+      params = {'duration': duration}
+      if results is not None:
+         params['results'] = results
+      resp = upstream.get('stops/{id}/departures'.format(id=id), params, priority)
+      if resp.status_code != 200:
+         return resp.status_code, None
+      return resp.status_code, resp.json()
+   (status, data), age = departure_cache.get((id, duration, results), load)
+   return status, data, age
+
+#fields of stops_table a client can see, in response order. stop_id and _links are always returned
+stop_fields       = ('stop_id','last_updated','name','latitude','longitude','next_departure')
+includable_fields = frozenset(stop_fields[1:])
+updatable_fields  = frozenset(['name','latitude','longitude','last_updated','next_departure'])
+written_fields    = updatable_fields | {'next_operator'}   # next_operator is only known for departures read from upstream
+
+#self links of the neighbouring stops, two seeks on the stop_id primary key
+neighbour_columns = ('(SELECT p.self FROM stops_table p WHERE p.stop_id < stops_table.stop_id ORDER BY p.stop_id DESC LIMIT 1) AS prev',
+                     '(SELECT n.self FROM stops_table n WHERE n.stop_id > stops_table.stop_id ORDER BY n.stop_id LIMIT 1) AS next')
+
+@lru_cache(maxsize=None)
+def select_stop_sql(fields, links=False):
+   # fields is a tuple checked against stop_fields, so it is safe to put into the statement
+   if not set(fields) <= set(stop_fields):
+      raise ValueError('unknown stop field in {f}'.format(f=fields))
+   columns = fields + ('self',)
+   if links:
+      columns += ('last_updated AS stored_updated', 'next_departure AS stored_departure', 'departure_refreshed', 'version') + neighbour_columns
+   return 'SELECT ' + ', '.join(columns) + ' FROM stops_table WHERE stop_id = ?'
+
+@lru_cache(maxsize=None)
+def update_stop_sql(fields):
+   if not set(fields) <= written_fields:
+      raise ValueError('unknown stop field in {f}'.format(f=fields))
+   return 'UPDATE stops_table SET ' + ', '.join(f + ' = ?' for f in fields) + ' WHERE stop_id = ?'
+
+def parse_include(include):
+   # turns the include list of ?include=name,latitude into the fields to display, in stop_fields order
+   if include is None:
+      return stop_fields
+   requested = include.split(',')
+   for para in requested:
+      if para == '_links' or para == 'stop_id':
+         api.abort(400, 'query is malformed, default parameters should not be included.')
+      if para not in includable_fields:
+         api.abort(400, 'query parameter is malformed')
+   return tuple(f for f in stop_fields if f == 'stop_id' or f in requested)
+
+def fetch_stop(db, id, fields=stop_fields, links=False):
+   # the requested fields (plus self, and with links the prev/next hrefs and stored departure)
+   # of one stop as a dict in a single query, None if it is not stored
+   row = db.execute(select_stop_sql(tuple(fields), links), (id,)).fetchone()
+   return dict(row) if row is not None else None
+
+def update_stop(db, id, values):
+   # writes every field of `values` with one UPDATE, the caller owns the transaction
+   fields = tuple(sorted(values))
+   db.execute(update_stop_sql(fields), tuple(values[f] for f in fields) + (id,))
+
+#stop payload validation, one check per updatable field built once and run over the whole payload
+last_updated_format  = "%Y-%m-%d-%H:%M:%S"
+last_updated_pattern = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}:[0-9]{2}:[0-9]{2}')
+last_updated_message = 'Invalid last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'
+
+def check_text(field):
+   def check(value):
+      if not isinstance(value, str):
+         return '{f} should be a string'.format(f=field)
+      if value == '':
+         return 'Empty string in {f} field is invalid'.format(f=field)
+   return check
+
+def check_coordinate(field, bound):
+   def check(value):
+      if isinstance(value, bool) or not isinstance(value, (int, float)):
+         return '{f} should be a number'.format(f=field)
+      if not -bound <= value <= bound:
+         return 'Invalid {f} value'.format(f=field)
+   return check
+
+def check_last_updated(value):
+   # the pattern checks the shape, strptime the calendar (month lengths, leap years, hh:mm:ss ranges)
+   if not isinstance(value, str) or not last_updated_pattern.fullmatch(value):
+      return last_updated_message
+   try:
+      datetime.strptime(value, last_updated_format)
+   except ValueError:
+      return 'Invalid date or time in last_updated, please refer to yyyy-mm-dd-hh:mm:ss'
+
+stop_checks = {
+   'name':           check_text('name'),
+   'next_departure': check_text('next_departure'),
+   'latitude':       check_coordinate('latitude', 90),
+   'longitude':      check_coordinate('longitude', 180),
+   'last_updated':   check_last_updated,
+}
+
+def validate_stop(stop):
+   # returns {field: message} for every problem in a stop update payload, empty when it can be written
+   if not isinstance(stop, dict):
+      return {'_': 'Invalid request format, please refer to stop model'}
+   errors = {}
+   for field, value in stop.items():
+      if field in ('stop_id', 'self', 'next', 'prev'):
+         errors[field] = 'Stop Id, links(self,next,prev) are not permitted parameters and cannot be changed'
+      elif field not in stop_checks:
+         errors[field] = 'Invalid request format, please refer to stop model'
+      else:
+         message = stop_checks[field](value)
+         if message is not None:
+            errors[field] = message
+   if not stop and not errors:
+      errors['_'] = 'Empty request is invalid'
+   return errors
+
+def validation_failed(errors):
+   # 400 body listing every error, the message is the error itself when there is only one
+   messages = list(errors.values())
+   message = messages[0] if len(messages) == 1 else '{n} validation errors'.format(n=len(messages))
+   return {'message': message, 'errors': errors}, 400
+
+def pick_next_departure(data):
+   # (text, operator name) of the first departure with a platform and a direction, (None, None) when there is none
+   for d in data['departures']:
+      if d['platform'] and d['direction']:
+         operator = (d['line'].get('operator') or {}).get('name')
+         return 'Platform {n} {name} towards {d}'.format(n=d['platform'],name=d['line']['id'],d=d['direction']), operator
+   return None, None
+
+def stop_response(id, fields):
+   # shared GET path: returns the requested fields, the response headers and the row version they were read at,
+   # None when another writer changed the stop while the departures board was loading.
+   # next_departure comes from the background refresher when it is recent enough, otherwise from the departures board
+   db = get_db()
+   row = fetch_stop(db, id, fields, links=True)
+   if row is None:
+      api.abort(404, 'Stop not found in DB')
+
+   refresher.touch(id)
+   result = {}
+   for p in fields:
+      result[p] = row[p]
+   result['_links'] = {'self':{'href':row['self']},'next':{'href':row['next']},'prev':{'href':row['prev']}}
+
+   refreshed = row['departure_refreshed']
+   if refresher.enabled and row['stored_departure'] and refreshed and time.time() - refreshed <= departure_refresh_max_age:
+      return result, {'X-Next-Departure-Age': str(int(time.time() - refreshed)), 'Last-Modified': last_modified(row['stored_updated'])}, row['version']
+
+   status, data, age = get_departures(id, 120)
+   if status != 200:
+      api.abort(503, 'Service is not avalaible at the time.')
+
+   next_dep, operator = pick_next_departure(data)
+   if next_dep is None:
+      api.abort(404, 'No departues in next 120 miniutes')
+
+   t = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+   #only written over the row that was read, the version trigger bumps it once more
+   version = None
+   with db:
+      written = db.execute('UPDATE stops_table SET last_updated = ?, next_departure = ?, next_operator = ?, departure_refreshed = ? where stop_id = ? AND version = ?',
+                           (t,next_dep,operator,time.time() - age,id,row['version'])).rowcount
+      if written:
+         version = db.execute('SELECT version FROM stops_table WHERE stop_id = ?', (id,)).fetchone()[0]
+
+   if 'last_updated' in result:
+      result['last_updated'] = t
+   if 'next_departure' in result:
+      result['next_departure'] = next_dep
+   return result, {'X-Next-Departure-Age': str(int(age)), 'Last-Modified': last_modified(t)}, version
+
+def last_modified(last_updated):
+   # HTTP date of a last_updated value (local time, yyyy-mm-dd-hh:mm:ss), None when it doesn't parse
+   try:
+      return http_date(datetime.strptime(last_updated, last_updated_format).astimezone())
+   except (TypeError, ValueError):
+      return None
+
+#stop response cache settings, can be tuned from the .env file
+stop_response_cache_size = int(os.environ.get('STOP_RESPONSE_CACHE_SIZE', 4096))   # serialized GET /stops/<id> bodies kept, 0 turns the cache off
+
+class StopResponseCache:
+   # serialized GET /stops/<id> bodies keyed by (stop_id, fields), kept while their next_departure is fresh.
+   # Each body remembers the row version it was built from and is only served while the stored version
+   # is the same, so writes made by another worker process are noticed as well
+   def __init__(self, maxsize):
+      self.maxsize = maxsize
+      self.entries = OrderedDict()
+      self.lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+      self.invalidations = 0
+
+   def get(self, key, version):
+      with self.lock:
+         entry = self.entries.get(key)
+         if entry is not None:
+            if entry['version'] == version and entry['expires'] > time.monotonic():
+               self.entries.move_to_end(key)
+               self.hits += 1
+               return entry
+            if entry['version'] != version:
+               self.invalidations += 1
+            del self.entries[key]
+         self.misses += 1
+         return None
+
+   def put(self, key, entry):
+      if self.maxsize <= 0:
+         return
+      with self.lock:
+         current = self.entries.get(key)
+         if current is not None and current['version'] > entry['version']:
+            return
+         self.entries[key] = entry
+         self.entries.move_to_end(key)
+         while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+   def invalidate(self, ids):
+      # drops every include set of the given stops after a local write, a stale body would only be
+      # caught by its version on the next lookup
+      ids = set(ids)
+      with self.lock:
+         self.invalidations += 1
+         for key in [k for k in self.entries if k[0] in ids]:
+            del self.entries[key]
+
+   def clear(self):
+      # inserts and deletes change the prev/next links of the neighbours as well
+      with self.lock:
+         self.invalidations += 1
+         self.entries.clear()
+
+   def stats(self):
+      with self.lock:
+         lookups = self.hits + self.misses
+         return {'maxsize': self.maxsize,
+                 'size': len(self.entries),
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'invalidations': self.invalidations,
+                 'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+stop_responses = StopResponseCache(stop_response_cache_size)
+
+def stop_representation(id, fields):
+   # GET /stops/<id> as a finished response with ETag, Last-Modified and Cache-Control. The body is
+   # served from stop_responses while fresh and still at the stored row version, and If-None-Match is
+   # answered with 304 when it still matches
+   key = (id, tuple(fields))
+   row = get_db().execute('SELECT version FROM stops_table WHERE stop_id = ?', (id,)).fetchone()
+   if row is None:
+      api.abort(404, 'Stop not found in DB')
+   entry = stop_responses.get(key, row[0])
+   if entry is None:
+      result, headers, version = stop_response(id, fields)
+      body = output_json_timed(result, 200).get_data()
+      age = int(headers['X-Next-Departure-Age'])
+      lifetime = max(0.0, departure_cache_ttl - age)
+      if refresher.enabled:
+         lifetime = max(0.0, min(departure_cache_ttl, departure_refresh_max_age - age))
+      now = time.monotonic()
+      entry = {'body': body,
+               'etag': hashlib.sha1(body).hexdigest()[:32],
+               'version': version,
+               'last_modified': headers.get('Last-Modified'),
+               'age': age,
+               'built': now,
+               'expires': now + lifetime}
+      if version is not None:
+         stop_responses.put(key, entry)
+   else:
+      refresher.touch(id)
+
+   now = time.monotonic()
+   headers = {'ETag': quote_etag(entry['etag']),
+              'Cache-Control': 'max-age={n}'.format(n=max(0, int(entry['expires'] - now))),
+              'X-Next-Departure-Age': str(entry['age'] + int(now - entry['built']))}
+   if entry['last_modified']:
+      headers['Last-Modified'] = entry['last_modified']
+   if request.if_none_match.contains_weak(entry['etag']):
+      return Response(status=304, headers=headers)
+   return Response(entry['body'], 200, headers, mimetype='application/json')
+
+#background departure refresher settings, can be tuned from the .env file
+departure_refresh_enabled  = os.environ.get('DEPARTURE_REFRESH', 'false').lower() in ('1', 'true', 'yes')
+departure_refresh_interval = float(os.environ.get('DEPARTURE_REFRESH_INTERVAL', 60))                 # seconds between two refresh rounds
+departure_refresh_workers  = int(os.environ.get('DEPARTURE_REFRESH_WORKERS', 4))                     # departures boards fetched at the same time
+departure_refresh_rate     = float(os.environ.get('DEPARTURE_REFRESH_RATE', 5))                      # max boards requested per second
+departure_refresh_max_age  = float(os.environ.get('DEPARTURE_REFRESH_MAX_AGE', 2 * departure_refresh_interval))  # oldest value a GET serves
+departure_touch_flush      = float(os.environ.get('DEPARTURE_TOUCH_FLUSH', 5))                       # seconds request times are buffered before they are written
+
+class DepartureRefresher:
+   # refreshes next_departure of every stored stop in rounds, most recently requested stops first,
+   # then the ones refreshed longest ago. Writes go to the db once per batch. Request times are kept
+   # in stops_table.last_requested, since only one serve worker runs the refresher
+   batch_size = 100
+
+   def __init__(self, enabled):
+      self.enabled = enabled
+      self.requested = {}
+      self.flushed = time.monotonic()
+      self.lock = threading.Lock()
+      self.stopping = threading.Event()
+      self.thread = None
+      self.pool = None
+      self.owner = False
+      self.lock_file = None
+      self.rounds = 0
+      self.refreshed = 0
+      self.failed = 0
+      self.last_round_seconds = None
+
+   def touch(self, id):
+      if self.enabled:
+         with self.lock:
+            self.requested[id] = time.time()
+            due = time.monotonic() - self.flushed >= departure_touch_flush
+         if due:
+            self.flush()
+
+   def flush(self):
+      # writes the buffered request times, one UPDATE per batch instead of one per request
+      with self.lock:
+         requested, self.requested = self.requested, {}
+         self.flushed = time.monotonic()
+      if requested:
+         with db_connection() as conn, conn:
+            conn.executemany('UPDATE stops_table SET last_requested = max(coalesce(last_requested, 0), ?) WHERE stop_id = ?',
+                             [(t, id) for id, t in requested.items()])
+
+   def start(self):
+      if not self.enabled or self.thread is not None:
+         return
+      self.stopping.clear()
+      self.pool = ThreadPoolExecutor(max_workers=departure_refresh_workers, thread_name_prefix='refresher')
+      self.thread = threading.Thread(target=self.run, name='departure-refresher', daemon=True)
+      self.thread.start()
+
+   def stop(self):
+      if self.thread is None:
+         return
+      self.stopping.set()
+      self.thread.join()
+      self.pool.shutdown(wait=True)
+      self.thread = None
+      if self.lock_file is not None:
+         self.lock_file.close()
+         self.lock_file = None
+      self.owner = False
+
+   def claim(self):
+      # one process per db_file runs refresh rounds: whichever holds the lock on db_file.refresher.
+      # The others keep trying, so the refresher moves on when its process exits
+      if fcntl is None:
+         return True
+      if self.lock_file is None:
+         self.lock_file = open(db_file + '.refresher', 'a')
+      try:
+         fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+         return False
+      return True
+
+   def run(self):
+      while not self.stopping.is_set():
+         if not self.owner:
+            self.owner = self.claim()
+            if not self.owner:
+               self.stopping.wait(departure_refresh_interval)
+               continue
+         started = time.monotonic()
+         try:
+            self.refresh_round()
+         except Exception:
+            logger.exception('departure refresh round failed')
+         self.last_round_seconds = time.monotonic() - started
+         self.stopping.wait(max(0.0, departure_refresh_interval - self.last_round_seconds))
+
+   def prioritized_ids(self):
+      #never requested and never refreshed stops sort last and first respectively, as NULLs do in the index
+      self.flush()
+      with db_pool.connection() as conn:
+         return [r[0] for r in conn.execute('SELECT stop_id FROM stops_table ORDER BY last_requested DESC, departure_refreshed')]
+
+   def refresh_one(self, id):
+      try:
+         status, data, age = get_departures(id, 120, priority='refresh')
+      except UpstreamUnavailable:
+         return None
+      #a stale board served in place of a failed reload is not a refresh
+      if status != 200 or age > departure_cache_ttl:
+         return None
+      next_dep, operator = pick_next_departure(data)
+      if next_dep is None:
+         return None
+      return (datetime.now().strftime("%Y-%m-%d-%H:%M:%S"), next_dep, operator, time.time() - age, id)
+
+   def refresh_round(self):
+      spacing = 1.0 / departure_refresh_rate if departure_refresh_rate > 0 else 0.0
+      ids = self.prioritized_ids()
+      for start in range(0, len(ids), self.batch_size):
+         futures = []
+         for id in ids[start:start + self.batch_size]:
+            if self.stopping.is_set() or upstream.breaker.state == 'open':
+               break
+            futures.append(self.pool.submit(self.refresh_one, id))
+            self.stopping.wait(spacing)
+         rows = [f.result() for f in futures]
+         updates = [r for r in rows if r is not None]
+         if updates:
+            with db_pool.connection() as conn, conn:
+               conn.executemany('UPDATE stops_table SET last_updated = ?, next_departure = ?, next_operator = ?, departure_refreshed = ? WHERE stop_id = ?', updates)
+            stop_responses.invalidate(u[-1] for u in updates)
+         self.refreshed += len(updates)
+         self.failed += len(rows) - len(updates)
+         if len(futures) < len(ids[start:start + self.batch_size]):
+            break
+      self.rounds += 1
+
+   def stats(self):
+      return {'enabled': self.enabled,
+              'owner': self.owner,
+              'interval': departure_refresh_interval,
+              'max_age': departure_refresh_max_age,
+              'rounds': self.rounds,
+              'refreshed': self.refreshed,
+              'failed': self.failed,
+              'last_round_seconds': self.last_round_seconds}
+
+refresher = DepartureRefresher(departure_refresh_enabled)
+
+#routes between stored stops: the source's next departure heads towards the destination, i.e. the destination's
+#name is a whole-word prefix of next_destination ("Berlin Hbf" routes "towards Berlin Hbf (tief)", not "towards Berlin Hbfs").
+#the stop_id scan over destinations stops at the first `limit` routes, sources are a range of the next_destination index
+guide_routes_sql = """SELECT s.stop_id AS source_id, s.name AS source, s.self AS source_self,
+                             d.stop_id AS destination_id, d.name AS destination, d.self AS destination_self,
+                             s.next_departure AS departure
+                      FROM stops_table d
+                      JOIN stops_table s ON s.next_destination >= d.name AND s.next_destination < d.name || char(1114111)
+                      WHERE trim(d.name) != '' AND s.stop_id != d.stop_id
+                        AND substr(s.next_destination, length(d.name) + 1, 1) NOT GLOB '[0-9A-Za-zÀ-ɏ]'
+                      ORDER BY d.stop_id
+                      LIMIT ?"""
+
+def guide_routes(db, limit):
+   return [dict(r) for r in db.execute(guide_routes_sql, (limit,))]
+
+#Gemini pipeline settings, can be tuned from the .env file
+gemini_workers = int(os.environ.get('GEMINI_WORKERS', 8))       # prompts sent to Gemini at the same time
+gemini_timeout = float(os.environ.get('GEMINI_TIMEOUT', 30))    # seconds allowed for one batch of prompts
+
+gemini_pool = ThreadPoolExecutor(max_workers=gemini_workers, thread_name_prefix='gemini')
+
+#Gemini answers cache, stored in the same SQLite file as stops_table
+gemini_cache_ttl  = float(os.environ.get('GEMINI_CACHE_TTL', 7 * 24 * 3600))   # seconds an answer is reused
+gemini_cache_size = int(os.environ.get('GEMINI_CACHE_SIZE', 5000))             # max answers kept, least recently used go first
+
+class GeminiCache:
+   def __init__(self, ttl, maxsize):
+      self.ttl = ttl
+      self.maxsize = maxsize
+      self.hits = 0
+      self.misses = 0
+      self.lock = threading.Lock()
+
+   @staticmethod
+   def key(question):
+      normalized = ' '.join(question.lower().split())
+      return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+   def get_many(self, questions):
+      # returns {index: answer} for the questions that have a fresh cached answer
+      keys = [self.key(q) for q in questions]
+      now = time.time()
+      placeholders = ','.join('?' * len(keys))
+      with db_connection() as conn:
+         rows = conn.execute('SELECT prompt_key, response FROM gemini_cache WHERE created > ? AND prompt_key IN (' + placeholders + ')',
+                             (now - self.ttl, *keys)).fetchall()
+         found = dict(rows)
+         if found:
+            with conn:
+               conn.executemany('UPDATE gemini_cache SET last_used = ?, hits = hits + 1 WHERE prompt_key = ?', [(now, k) for k in found])
+      with self.lock:
+         self.hits += len(found)
+         self.misses += len(keys) - len(found)
+      return {i: found[k] for i, k in enumerate(keys) if k in found}
+
+   def put(self, question, answer):
+      now = time.time()
+      with db_connection() as conn, conn:
+         conn.execute('''INSERT INTO gemini_cache (prompt_key, prompt, response, created, last_used, hits)
+                         VALUES (?,?,?,?,?,0)
+                         ON CONFLICT(prompt_key) DO UPDATE SET response = excluded.response, created = excluded.created, last_used = excluded.last_used''',
+                      (self.key(question), question, answer, now, now))
+         conn.execute('DELETE FROM gemini_cache WHERE prompt_key IN (SELECT prompt_key FROM gemini_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                      (self.maxsize,))
+
+   def invalidate(self, question=None):
+      with db_connection() as conn, conn:
+         if question is None:
+            return conn.execute('DELETE FROM gemini_cache').rowcount
+         return conn.execute('DELETE FROM gemini_cache WHERE prompt_key = ?', (self.key(question),)).rowcount
+
+   def stats(self):
+      with db_connection() as conn:
+         size = conn.execute('SELECT COUNT(*) FROM gemini_cache').fetchone()[0]
+      with self.lock:
+         lookups = self.hits + self.misses
+         return {'ttl': self.ttl,
+                 'maxsize': self.maxsize,
+                 'size': size,
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+gemini_cache = GeminiCache(gemini_cache_ttl, gemini_cache_size)
+
+def ask_gemini(question):
+   started = time.perf_counter()
+   outcome = 'error'
+   try:
+      answer = gemini.generate_content(question, request_options={'timeout': gemini_timeout}).text
+      outcome = 'ok'
+      return answer
+   finally:
+      metrics.observe('upstream_request_duration_seconds', time.perf_counter() - started, target='gemini', outcome=outcome)
+
+def gemini_answers(questions):
+   # yields (index, answer) in completion order, answer is None when that prompt failed or timed out.
+   # cached answers come first, only the remaining prompts are sent to Gemini
+   cached = gemini_cache.get_many(questions)
+   for i, answer in cached.items():
+      yield i, answer
+
+   futures = {gemini_pool.submit(ask_gemini, q): i for i, q in enumerate(questions) if i not in cached}
+   pending = set(futures)
+   try:
+      for f in as_completed(futures, timeout=gemini_timeout):
+         pending.discard(f)
+         try:
+            answer = f.result()
+         except Exception as e:
+            logger.warning('Gemini prompt failed: %s', e)
+            answer = None
+         if answer is not None:
+            gemini_cache.put(questions[futures[f]], answer)
+         yield futures[f], answer
+   except FuturesTimeout:
+      for f in pending:
+         f.cancel()
+         logger.warning('Gemini prompt timed out after %ss', gemini_timeout)
+         yield futures[f], None
+
+def ask_gemini_all(questions):
+   started = time.perf_counter()
+   answers = [None] * len(questions)
+   for i, answer in gemini_answers(questions):
+      answers[i] = answer
+   record_phase('gemini', time.perf_counter() - started)
+   return answers
+
+#rendered /guide downloads, stored next to the Gemini answers they are made of
+guide_cache_ttl  = float(os.environ.get('GUIDE_CACHE_TTL', gemini_cache_ttl))   # seconds a guide is reused
+guide_cache_size = int(os.environ.get('GUIDE_CACHE_SIZE', 1000))                 # max guides kept, least recently used go first
+
+class GuideCache:
+   # complete guides addressed by a hash of their (source, destination) route
+   def __init__(self, ttl, maxsize):
+      self.ttl = ttl
+      self.maxsize = maxsize
+      self.hits = 0
+      self.misses = 0
+      self.lock = threading.Lock()
+
+   @staticmethod
+   def key(source, destination):
+      return hashlib.sha256('{s}\0{d}'.format(s=source, d=destination).encode('utf-8')).hexdigest()
+
+   def get(self, source, destination):
+      key = self.key(source, destination)
+      now = time.time()
+      with db_connection() as conn:
+         row = conn.execute('SELECT body FROM guide_cache WHERE guide_key = ? AND created > ?', (key, now - self.ttl)).fetchone()
+         if row is not None:
+            with conn:
+               conn.execute('UPDATE guide_cache SET last_used = ?, hits = hits + 1 WHERE guide_key = ?', (now, key))
+      with self.lock:
+         if row is None:
+            self.misses += 1
+         else:
+            self.hits += 1
+      return row[0] if row is not None else None
+
+   def put(self, source, destination, body):
+      now = time.time()
+      with db_connection() as conn, conn:
+         conn.execute('''INSERT INTO guide_cache (guide_key, source, destination, body, created, last_used, hits)
+                         VALUES (?,?,?,?,?,?,0)
+                         ON CONFLICT(guide_key) DO UPDATE SET body = excluded.body, created = excluded.created, last_used = excluded.last_used''',
+                      (self.key(source, destination), source, destination, body, now, now))
+         conn.execute('DELETE FROM guide_cache WHERE guide_key IN (SELECT guide_key FROM guide_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                      (self.maxsize,))
+
+   def invalidate(self):
+      with db_connection() as conn, conn:
+         return conn.execute('DELETE FROM guide_cache').rowcount
+
+   def stats(self):
+      with db_connection() as conn:
+         size = conn.execute('SELECT COUNT(*) FROM guide_cache').fetchone()[0]
+      with self.lock:
+         lookups = self.hits + self.misses
+         return {'ttl': self.ttl,
+                 'maxsize': self.maxsize,
+                 'size': size,
+                 'hits': self.hits,
+                 'misses': self.misses,
+                 'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+guide_cache = GuideCache(guide_cache_ttl, guide_cache_size)
+
+def answers_in_order(questions):
+   # yields the answers of gemini_answers in question order, each one as soon as it and all before it are in
+   answers = {}
+   next_index = 0
+   for i, answer in gemini_answers(questions):
+      answers[i] = answer
+      while next_index in answers:
+         yield answers.pop(next_index)
+         next_index += 1
+
+#stop listing settings, can be tuned from the .env file
+stops_page_size     = int(os.environ.get('STOPS_PAGE_SIZE', 100))     # stops per page when no limit is given
+stops_max_page_size = int(os.environ.get('STOPS_MAX_PAGE_SIZE', 1000))
+
+#filters of the stop listing: query argument -> (condition, converter)
+stop_filters = {
+   'name':          ("name LIKE '%' || ? || '%'", str),
+   'min_lat':       ('latitude >= ?', float),
+   'max_lat':       ('latitude <= ?', float),
+   'min_lon':       ('longitude >= ?', float),
+   'max_lon':       ('longitude <= ?', float),
+   'updated_since': ('last_updated_ts >= ?', lambda v: datetime.strptime(v, last_updated_format).timestamp()),
+}
+
+def stop_listing_query(fields, after=None, order='asc', filters=(), limit=None):
+   # keyset query over the stop_id primary key, so every page costs the same however deep it is
+   where = []
+   params = []
+   if after is not None:
+      where.append('stop_id > ?' if order == 'asc' else 'stop_id < ?')
+      params.append(after)
+   for arg, value in filters:
+      where.append(stop_filters[arg][0])
+      params.append(value)
+   sql = 'SELECT ' + ', '.join(fields + ('self',)) + ' FROM stops_table'
+   if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+   sql += ' ORDER BY stop_id ' + ('ASC' if order == 'asc' else 'DESC')
+   if limit is not None:
+      sql += ' LIMIT ?'
+      params.append(limit)
+   return sql, params
+
+def iter_stops(conn, sql, params, fields):
+   # walks the cursor in batches, only one batch of rows is held in memory at a time
+   cursor = conn.execute(sql, params)
+   while True:
+      rows = cursor.fetchmany(500)
+      if not rows:
+         break
+      for row in rows:
+         d = {}
+         for col in fields:
+            d[col] = row[col]
+         d['_links'] = {'self':{'href':row['self']}}
+         yield d
+
+def next_page_link(page, limit):
+   # href of the page after `page`, None on the last page
+   if len(page) < limit:
+      return None
+   args = request.args.to_dict()
+   args['after'] = page[-1]['stop_id']
+   return request.base_url + '?' + urlencode(args)
+
+#nearby search settings
+earth_radius      = 6371008.8                                          # meters
+nearby_max_k      = int(os.environ.get('NEARBY_MAX_K', 1000))
+nearby_min_radius = 1000.0                                             # first radius tried by a k nearest search, in meters
+
+def distances(lat, lon, lats, lons):
+   # great circle distance in meters from (lat, lon) to every point of the lats/lons arrays
+   lat1 = np.radians(lat)
+   lat2 = np.radians(lats)
+   a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(np.radians(lons - lon) / 2) ** 2
+   return 2 * earth_radius * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def bounding_box(lat, lon, radius):
+   # (min_lat, max_lat, min_lon, max_lon) of a box holding the circle, the whole longitude range near poles or the dateline
+   dlat = np.degrees(radius / earth_radius)
+   min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+   coslat = np.cos(np.radians(max(abs(min_lat), abs(max_lat))))
+   dlon = np.degrees(radius / (earth_radius * coslat)) if coslat > 1e-9 else 360.0
+   if dlon >= 180 or lon - dlon < -180 or lon + dlon > 180:
+      return min_lat, max_lat, -180.0, 180.0
+   return min_lat, max_lat, lon - dlon, lon + dlon
+
+def count_in_box(db, box):
+   return db.execute('SELECT COUNT(*) FROM stops_rtree WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?', box).fetchone()[0]
+
+def candidates_in_box(db, lat, lon, box):
+   # (stop_ids, distances) of the R*Tree entries in the box, read straight from the index as plain tuples.
+   # The index keeps 32 bit coordinates, so these distances are within a meter of the exact ones
+   cursor = db.cursor()
+   cursor.row_factory = None
+   rows = cursor.execute("""SELECT stop_id, (min_lat + max_lat) / 2, (min_lon + max_lon) / 2 FROM stops_rtree
+                            WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?""", box).fetchall()
+   if not rows:
+      return np.empty(0, dtype=np.int64), np.empty(0)
+   candidates = np.array(rows, dtype=float)
+   return candidates[:, 0].astype(np.int64), distances(lat, lon, candidates[:, 1], candidates[:, 2])
+
+def nearest_stops(db, lat, lon, k, radius=None):
+   # k nearest stops, within `radius` meters when given. Without a radius the box grows (counting through
+   # the R*Tree only) until it holds k stops, and is then narrowed by bisection so few candidates are read
+   #the caller's radius is a hard limit, one found from the index coordinates is not
+   cut = radius
+   if radius is None:
+      low, radius = 0.0, nearby_min_radius
+      while count_in_box(db, bounding_box(lat, lon, radius)) < k and radius < np.pi * earth_radius:
+         low, radius = radius, radius * 2
+      while radius - low > 1.0 and count_in_box(db, bounding_box(lat, lon, radius)) > 4 * k + 256:
+         middle = (low + radius) / 2
+         if count_in_box(db, bounding_box(lat, lon, middle)) >= k:
+            radius = middle
+         else:
+            low = middle
+      ids, dist = candidates_in_box(db, lat, lon, bounding_box(lat, lon, radius))
+      if len(ids) >= k:
+         radius = float(np.partition(dist, k - 1)[k - 1])
+      cut = radius + 1.0
+
+   #one meter of slack covers the rounding of the index coordinates, exact distances decide below
+   ids, dist = candidates_in_box(db, lat, lon, bounding_box(lat, lon, radius + 1.0))
+   inside = np.flatnonzero(dist <= radius + 1.0)
+   chosen = inside[np.argsort(dist[inside], kind='stable')][:k + 8]
+   if len(chosen) == 0:
+      return []
+   wanted = [int(i) for i in ids[chosen]]
+   rows = db.execute('SELECT stop_id, name, latitude, longitude, self FROM stops_table WHERE stop_id IN (' + ','.join('?' * len(wanted)) + ')',
+                     wanted).fetchall()
+   exact = distances(lat, lon, np.array([r['latitude'] for r in rows]), np.array([r['longitude'] for r in rows]))
+   order = [i for i in np.argsort(exact, kind='stable') if exact[i] <= cut][:k]
+   return [(rows[i], float(exact[i])) for i in order]
+
+#export and summary settings, can be tuned from the .env file
+export_chunk_size = int(os.environ.get('EXPORT_CHUNK_SIZE', 50000))   # stops read (and written) per chunk, bounds the memory of one export
+
+#exported columns and their arrow types, fixed so that every chunk has the same schema
+export_columns = (('stop_id', 'int64'), ('name', 'string'), ('latitude', 'double'), ('longitude', 'double'),
+                  ('last_updated', 'string'), ('last_updated_ts', 'int64'), ('next_departure', 'string'),
+                  ('next_operator', 'string'), ('self', 'string'))
+#format -> (mimetype, file extension, needs pyarrow)
+export_formats = {'csv':     ('text/csv', 'csv', False),
+                  'parquet': ('application/vnd.apache.parquet', 'parquet', True),
+                  'arrow':   ('application/vnd.apache.arrow.stream', 'arrows', True)}
+
+def stop_chunks(conn, columns):
+   # stops_table in stop_id order as DataFrames of at most export_chunk_size rows
+   sql = 'SELECT ' + ', '.join(columns) + ' FROM stops_table ORDER BY stop_id'
+   return pd.read_sql_query(sql, conn, chunksize=export_chunk_size)
+
+class StreamSink:
+   # write-only file object for the pyarrow writers, drain() hands out what was written since the last call
+   closed = False
+
+   def __init__(self):
+      self.chunks = []
+      self.position = 0
+
+   def write(self, data):
+      self.chunks.append(bytes(data))
+      self.position += len(data)
+      return len(data)
+
+   def tell(self):
+      return self.position
+
+   def flush(self):
+      pass
+
+   def close(self):
+      self.closed = True
+
+   def drain(self):
+      data = b''.join(self.chunks)
+      self.chunks = []
+      return data
+
+def export_stops(format):
+   # yields the encoded table chunk by chunk, nothing but the current chunk is held in memory
+   columns = [c for c, _ in export_columns]
+   with db_pool.connection() as conn:
+      chunks = stop_chunks(conn, columns)
+      if format == 'csv':
+         for i, chunk in enumerate(chunks):
+            yield chunk.to_csv(index=False, header=(i == 0))
+         return
+
+      schema = pa.schema([(c, pa.type_for_alias(t)) for c, t in export_columns])
+      sink = StreamSink()
+      writer = pq.ParquetWriter(sink, schema) if format == 'parquet' else pa.ipc.new_stream(sink, schema)
+      for chunk in chunks:
+         writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+         yield sink.drain()
+      writer.close()
+      yield sink.drain()
+
+#last_updated ages, in seconds, the summary counts stops by
+staleness_edges  = np.array([-np.inf, 60, 300, 900, 3600, 6 * 3600, 86400, 7 * 86400, np.inf])
+staleness_labels = ('<1m', '1m-5m', '5m-15m', '15m-1h', '1h-6h', '6h-1d', '1d-7d', '>7d')
+departure_line   = r'^Platform \S+ (\S+) towards '   # line id inside a next_departure text
+
+def summarize_stops(conn, boxes, cell, top):
+   # one pass over stops_table in chunks, every statistic is updated with whole-chunk numpy/pandas operations.
+   # boxes is an (n, 4) array of min_lat, min_lon, max_lat, max_lon; without boxes stops are counted per cell x cell degrees
+   now = time.time()
+   total = 0
+   box_counts = np.zeros(len(boxes), dtype=np.int64)
+   cell_counts = []
+   age_counts = np.zeros(len(staleness_labels), dtype=np.int64)
+   ages = []
+   departures = pd.Series(dtype=np.int64, index=pd.Index([], dtype=object))
+   operators = pd.Series(dtype=np.int64, index=pd.Index([], dtype=object))
+
+   for chunk in stop_chunks(conn, ('latitude', 'longitude', 'last_updated_ts', 'next_departure', 'next_operator')):
+      total += len(chunk)
+      lat = chunk['latitude'].to_numpy(dtype=float)
+      lon = chunk['longitude'].to_numpy(dtype=float)
+      if len(boxes):
+         inside = ((lat[:, None] >= boxes[:, 0]) & (lon[:, None] >= boxes[:, 1]) &
+                   (lat[:, None] <= boxes[:, 2]) & (lon[:, None] <= boxes[:, 3]))
+         box_counts += inside.sum(axis=0)
+      else:
+         located = ~(np.isnan(lat) | np.isnan(lon))
+         cells = pd.DataFrame({'lat': np.floor(lat[located] / cell).astype(np.int64),
+                               'lon': np.floor(lon[located] / cell).astype(np.int64)})
+         cell_counts.append(cells.value_counts())
+
+      age = now - chunk['last_updated_ts'].to_numpy(dtype=float)
+      age = age[~np.isnan(age)]
+      age_counts += np.histogram(age, staleness_edges)[0]
+      ages.append(age)
+
+      departures = departures.add(chunk['next_departure'].value_counts(), fill_value=0)
+      operators = operators.add(chunk['next_operator'].value_counts(), fill_value=0)
+
+   if len(boxes):
+      areas = [{'min_lat': b[0], 'min_lon': b[1], 'max_lat': b[2], 'max_lon': b[3], 'stops': int(n)}
+               for b, n in zip(boxes.tolist(), box_counts)]
+   elif cell_counts:
+      cell_counts = pd.concat(cell_counts).groupby(level=['lat', 'lon']).sum()
+      areas = [{'min_lat': i * cell, 'min_lon': j * cell, 'max_lat': (i + 1) * cell, 'max_lon': (j + 1) * cell, 'stops': int(n)}
+               for (i, j), n in cell_counts.sort_values(ascending=False, kind='stable').items()]
+   else:
+      areas = []
+
+   #the line is parsed once per distinct departure text rather than once per stop
+   lines = departures.dropna()
+   if len(lines):
+      lines = lines.groupby(lines.index.str.extract(departure_line, expand=False)).sum()
+
+   ages = np.concatenate(ages) if ages else np.empty(0)
+   staleness = {'stops': dict(zip(staleness_labels, age_counts.tolist())),
+                'unknown': total - len(ages)}
+   if len(ages):
+      p50, p90, p99 = np.percentile(ages, [50, 90, 99])
+      staleness.update({'p50_seconds': round(float(p50), 1), 'p90_seconds': round(float(p90), 1),
+                        'p99_seconds': round(float(p99), 1), 'max_seconds': round(float(ages.max()), 1)})
+
+   return {'stops': total,
+           'areas': areas,
+           'staleness': staleness,
+           'lines': [{'line': k, 'stops': int(n)} for k, n in lines.nlargest(top).items()],
+           'operators': [{'operator': k, 'stops': int(n)} for k, n in operators.nlargest(top).items()]}
+
+#bulk import settings, can be tuned from the .env file
+import_workers   = int(os.environ.get('IMPORT_WORKERS', 8))         # location lookups sent to the API at the same time
+import_max_items = int(os.environ.get('IMPORT_MAX_ITEMS', 10000))   # queries accepted by one import request
+
+import_pool = ThreadPoolExecutor(max_workers=import_workers, thread_name_prefix='import')
+
+def lookup_locations(query, priority='interactive'):
+   # returns (status_code, locations) of a locations query such as query=Berlin Hbf
+   resp = upstream.get('locations?{query}'.format(query = query + '&results=5'), priority=priority)
+   if resp.status_code != 200:
+      return resp.status_code, None
+   return resp.status_code, resp.json()
+
+def location_rows(locations, t):
+   # (stop_id,name,latitude,longitude,last_updated,self) tuples of the stops among the locations
+   rows = []
+   for n in locations:
+      if n['type'] == 'stop':
+         self = 'http://127.0.0.1:5000/stops/{id}'.format(id=n['id'])
+         rows.append((int(n['id']), n['name'], n['location']['latitude'], n['location']['longitude'], t, self))
+   return rows
+
+def upsert_stops(db, rows):
+   # inserts new stops and refreshes last_updated of stored ones in one transaction, returns the created stop_ids
+   ids = list({r[0] for r in rows})
+   existing = set()
+   for i in range(0, len(ids), 500):
+      chunk = ids[i:i + 500]
+      existing.update(r[0] for r in db.execute('SELECT stop_id FROM stops_table WHERE stop_id IN (' + ','.join('?' * len(chunk)) + ')', chunk))
+   with db:
+      db.executemany("""INSERT INTO stops_table (stop_id,name,latitude,longitude,last_updated,self)
+                        VALUES (?,?,?,?,?,?)
+                        ON CONFLICT(stop_id) DO UPDATE SET last_updated = excluded.last_updated""", rows)
+   stop_responses.clear()
+   return set(ids) - existing
+
 @api.route('/stops/<string:query>', endpoint = 'stops')
 @api.param('query','query string in the form of : query={name of the stop}')  
 class GetStops(Resource):
@@ -61,225 +1775,326 @@ class GetStops(Resource):
    @api.response(400, 'Query Malformed')
    @api.response(503, 'Service Not Avalaible')
    def put(self, query):
-      resp = rq.get('{api_url}locations?{query}'.format(api_url=api_url, query = query + '&results=5'))
-      data = resp.json()
+      db = get_db()
+      status, data = lookup_locations(query)
 
-      if resp.status_code != 200:
-         if resp.status_code == 404:
+      if status != 200:
+         if status == 404:
             api.abort(404,'Stop queried does not exist.')
-         if resp.status_code == 400:
+         if status == 400:
             api.abort(400, 'query is malformed.')
-         if resp.status_code == 503:
-            api.abort(503, 'Service is not avalaible at the time.')
-
-      for n in data:
-         code = 200
-         if n['type'] == 'stop':
-            t = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-            self = 'http://127.0.0.1:5000/stops/{id}'.format(id=n['id'])
-            id = int(n['id'])
-            name = n['name']
-            latitude = n['location']['latitude']
-            longitude = n['location']['longitude']
-            cur.execute('SELECT * FROM stops_table WHERE stop_id = ?', (id,))
-            selected = cur.fetchone()
-            if selected is None:
-               insert_query = """INSERT INTO stops_table 
-                                 (stop_id,name,latitude,longitude,last_updated,self)
-                                 VALUES
-                                 (?,?,?,?,?,?);"""
-               data_tuple = (id,name,latitude,longitude,t,self)
-               cur.execute(insert_query,data_tuple)
-               con.commit()
-               code = 201
-            else:
-               update_query = '''UPDATE stops_table SET last_updated = ? where stop_id = ?'''
-               data_tuple = (t,id)
-               cur.execute(update_query, data_tuple)
-               con.commit()
-
-         rows = cur.execute('SELECT stop_id, last_updated,self FROM stops_table ORDER BY stop_id').fetchall()
-         result = []
-         for row in rows:
-            d = {}
-            for i, col in enumerate(['stop_id','last_updated','_links']):
-               if col != '_links':
-                  d[col] = row[i]
-               else:
-                  d[col] = {'self':{'href':row[i]}}
-            result.append(d)
-
-      return result, code
-   
-@api.route('/stops/<string:include>')
-@api.param('include','include query string in the from of : {stop_id}?inlcude={parameters to be included}')  
-class StopsInclude(Resource):
-   @api.doc(description='retrieve information about a stop in Database from Deutsche Bahn API')
+         api.abort(503, 'Service is not avalaible at the time.')
+
+      t = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+      created = upsert_stops(db, location_rows(data, t))
+
+      #the status follows the last location returned, as it always has
+      code = 200
+      if data and data[-1]['type'] == 'stop' and int(data[-1]['id']) in created:
+         code = 201
+
+      #first page of the listing, the rest is available from GET /stops
+      fields = ('stop_id','last_updated')
+      sql, params = stop_listing_query(fields, limit=stops_page_size)
+      result = list(iter_stops(db, sql, params, fields))
+      headers = {}
+      if len(result) == stops_page_size:
+         headers['Link'] = '<{url}?after={after}>; rel="next"'.format(url=api.url_for(StopsCollection, _external=True), after=result[-1]['stop_id'])
+
+      return result, code, headers
+
+#batch update settings, can be tuned from the .env file
+stops_max_patch = int(os.environ.get('STOPS_MAX_PATCH', 1000))   # stops accepted by one PATCH /stops
+
+stop_patch_model = api.model('StopPatch', {
+    'stop_id': fields.Integer(required=True),
+    'name': fields.String,
+    'latitude': fields.Float,
+    'longitude': fields.Float,
+    'last_updated': fields.String(example='yyyy-mm-dd-hh:mm:ss'),
+    'next_departure':fields.String
+})
+stops_patch_model = api.model('StopsPatch', {
+    'stops': fields.List(fields.Nested(stop_patch_model))
+})
+
+@api.route('/stops')
+class StopsCollection(Resource):
+   @api.doc(description='list stored stops page by page, ordered by stop_id. format=ndjson streams every matching stop as json lines',
+            params={'after': 'stop_id to continue after (keyset cursor)',
+                    'limit': 'stops per page, at most {n}'.format(n=stops_max_page_size),
+                    'fields': 'comma separated fields to include besides stop_id, e.g. name,latitude',
+                    'order': 'asc (default) or desc',
+                    'name': 'only stops whose name contains this text',
+                    'min_lat': 'minimum latitude', 'max_lat': 'maximum latitude',
+                    'min_lon': 'minimum longitude', 'max_lon': 'maximum longitude',
+                    'updated_since': 'only stops updated at or after yyyy-mm-dd-hh:mm:ss',
+                    'format': 'json (default) or ndjson'})
    @api.response(200, 'OK')
-   @api.response(404, 'Stop Not Found')
    @api.response(400, 'Query Malformed')
-   @api.response(503, 'Service Not Avalaible')
-   def get(self, include):
-      query = include
-      display = []
-      if query.isdigit():
-         id = int(query)
-      else:
-         index_n = query.index('?') if '?' in query else -1
-         if query[:index_n].isdigit():
-            id = int(query[:index_n])
-            rest = query[index_n:]
-            if rest[:9] == '?include=':
-               rest = rest[9:]
-
-               rest = rest.split(',')
-              
-               for para in rest:
-                  if para == '_links' or para =='stop_id':
-                     api.abort(400, 'query is malformed, default parameters should not be included.')
-                  if para != 'last_updated' and para != 'name' and para != 'latitude' and para != 'longitude' and para != 'next_departure':
-                     api.abort(400, 'query parameter is malformed')
-               
-               display.append('stop_id')
-
-               if 'last_updated' in rest:
-                  display.append('last_updated')
-               if 'name' in rest:
-                  display.append('name')
-               if 'latitude' in rest:
-                  display.append('latitude')
-               if 'longitude' in rest:
-                  display.append('longitude')
-               if 'next_departure' in rest:
-                  display.append('next_departure')
-
-               display.append('_links')
-            else:
-               api.abort(400, 'query string word is malformed.')
+   def get(self):
+      args = request.args
+      fields = parse_include(args['fields']) if 'fields' in args else ('stop_id','last_updated')
+      order = args.get('order', 'asc')
+      if order not in ('asc', 'desc'):
+         api.abort(400, 'order should be asc or desc')
+      stream = args.get('format', 'json') == 'ndjson'
+      try:
+         after = int(args['after']) if 'after' in args else None
+         limit = int(args['limit']) if 'limit' in args else (None if stream else stops_page_size)
+         filters = [(arg, stop_filters[arg][1](args[arg])) for arg in stop_filters if arg in args]
+      except ValueError:
+         api.abort(400, 'query parameter is malformed')
+      if limit is not None and not 0 < limit <= stops_max_page_size:
+         api.abort(400, 'limit should be between 1 and {n}'.format(n=stops_max_page_size))
+
+      sql, params = stop_listing_query(fields, after, order, filters, limit)
+
+      if stream:
+         def generate():
+            with db_pool.connection() as conn:
+               for d in iter_stops(conn, sql, params, fields):
+                  yield json.dumps(d) + '\n'
+         return Response(generate(), mimetype='application/x-ndjson')
+
+      page = list(iter_stops(get_db(), sql, params, fields))
+      result = {'stops': page, 'count': len(page), '_links': {'self': {'href': request.url}}}
+      next_href = next_page_link(page, limit)
+      if next_href:
+         result['_links']['next'] = {'href': next_href}
+      return result, 200
+
+   @api.doc(description='update many stops in one transaction: either every stop is updated or, on any error, none is')
+   @api.response(200, 'OK')
+   @api.response(400, 'Validation Error, errors lists every problem by position in stops')
+   @api.response(404, 'Stop was not found, missing lists the stop_ids')
+   @api.expect(stops_patch_model)
+   def patch(self):
+      body = request.get_json(silent=True)
+      stops = body.get('stops') if isinstance(body, dict) else None
+      if not isinstance(stops, list) or not stops:
+         return {'message':'Expected a json body with a non empty stops list'}, 400
+      if len(stops) > stops_max_patch:
+         return {'message':'Too many stops, at most {n} per request'.format(n=stops_max_patch)}, 400
+
+      errors = {}
+      updates = {}
+      for i, stop in enumerate(stops):
+         values = dict(stop) if isinstance(stop, dict) else stop
+         id = values.pop('stop_id', None) if isinstance(values, dict) else None
+         item_errors = validate_stop(values)
+         if isinstance(id, bool) or not isinstance(id, int) or id <= 0:
+            item_errors['stop_id'] = 'stop_id should be a positive integer'
+         elif id in updates:
+            item_errors['stop_id'] = 'stop_id {id} is given more than once'.format(id=id)
+         if item_errors:
+            errors[i] = item_errors
          else:
-            api.abort(400, 'query is malformed.')
-      
-      if display == ['stop_id','_links'] or display == []:
-         display = ['stop_id','last_updated','name','latitude','longitude','next_departure','_links']
+            updates[id] = values
+      if errors:
+         return {'message': '{n} invalid stop(s)'.format(n=len(errors)), 'errors': errors}, 400
 
-      cur.execute('SELECT * FROM stops_table WHERE stop_id = ?', (id,))
-      selected = cur.fetchone()
-      if selected is None:
-         api.abort(404, 'Stop not found in DB')
-      
-      resp = rq.get('{api_url}stops/{id}/departures?duration=120'.format(api_url=api_url, id = id))
-      data = resp.json()
+      db = get_db()
+      ids = list(updates)
+      found = {}
+      for i in range(0, len(ids), 500):
+         chunk = ids[i:i + 500]
+         found.update(db.execute('SELECT stop_id, self FROM stops_table WHERE stop_id IN (' + ','.join('?' * len(chunk)) + ')', chunk).fetchall())
+      missing = [id for id in ids if id not in found]
+      if missing:
+         return {'message': "{n} stop(s) don't exist".format(n=len(missing)), 'missing': missing}, 404
 
-      if resp.status_code == 503:
-         api.abort(503, 'Service is not avalaible at the time.')
+      #one executemany per set of updated fields
+      t = datetime.now().strftime(last_updated_format)
+      groups = defaultdict(list)
+      for id, values in updates.items():
+         values.setdefault('last_updated', t)
+         if 'next_departure' in values:
+            values['next_operator'] = None
+         fields = tuple(sorted(values))
+         groups[fields].append(tuple(values[f] for f in fields) + (id,))
+      with db:
+         for fields, rows in groups.items():
+            db.executemany(update_stop_sql(fields), rows)
+      stop_responses.invalidate(ids)
 
-      if data['departures'] == []:
-         api.abort(404, 'No departues in next 120 miniutes')
-      else:
-         for d in data['departures']:
-            if d['platform'] and d['direction']:
-               des = d
-               break
-      
+      result = [{'stop_id': id, 'last_updated': updates[id]['last_updated'], '_links': {'self': {'href': found[id]}}} for id in ids]
+      return {'updated': len(result), 'stops': result}, 200
 
-      cur.execute('SELECT DISTINCT self from stops_table WHERE stop_id < ? ORDER BY stop_id DESC',(id,))
-      prev = cur.fetchone()[0]
-      cur.execute('SELECT DISTINCT self from stops_table WHERE stop_id > ? ORDER BY stop_id',(id,))
-      next = cur.fetchone()[0]
+@api.route('/stops/nearby')
+class StopsNearby(Resource):
+   @api.doc(description='stored stops near a point, nearest first. With radius all stops within it (up to k), without radius the k nearest',
+            params={'lat': 'latitude of the point', 'lon': 'longitude of the point',
+                    'radius': 'search radius in meters (optional)',
+                    'k': 'number of stops to return, default 10, at most {n}'.format(n=nearby_max_k)})
+   @api.response(200, 'OK')
+   @api.response(400, 'Query Malformed')
+   def get(self):
+      args = request.args
+      try:
+         lat = float(args['lat'])
+         lon = float(args['lon'])
+         radius = float(args['radius']) if 'radius' in args else None
+         k = int(args.get('k', 10))
+      except (KeyError, ValueError):
+         api.abort(400, 'lat and lon are required numbers, radius and k are optional numbers')
+      if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+         api.abort(400, 'Invalid latitude or longitude value')
+      if radius is not None and radius <= 0:
+         api.abort(400, 'radius should be positive')
+      if not 0 < k <= nearby_max_k:
+         api.abort(400, 'k should be between 1 and {n}'.format(n=nearby_max_k))
 
-      update_query = '''UPDATE stops_table SET last_updated = ?, next_departure = ?, next = ?, prev = ? where stop_id = ?'''
-      t = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-      next_dep = 'Platform {n} {name} towards {d}'.format(n=des['platform'],name=des['line']['id'],d=des['direction'])
-      data_tuple = (t,next_dep,next,prev,id)
-      cur.execute(update_query, data_tuple)
-      con.commit()
+      result = []
+      for row, distance in nearest_stops(get_db(), lat, lon, k, radius):
+         result.append({'stop_id': row['stop_id'],
+                        'name': row['name'],
+                        'latitude': row['latitude'],
+                        'longitude': row['longitude'],
+                        'distance': round(distance, 1),
+                        '_links': {'self': {'href': row['self']}}})
+      return {'stops': result, 'count': len(result)}, 200
 
+@api.route('/stops/export')
+class StopsExport(Resource):
+   @api.doc(description='download every stored stop, streamed in chunks of {n} stops. parquet and arrow need pyarrow to be installed'.format(n=export_chunk_size),
+            params={'format': 'csv (default), parquet or arrow (IPC stream)'})
+   @api.response(200, 'OK')
+   @api.response(400, 'Query Malformed')
+   @api.response(501, 'Format not available, pyarrow is not installed')
+   def get(self):
+      format = request.args.get('format', 'csv')
+      if format not in export_formats:
+         api.abort(400, 'format should be one of {f}'.format(f=', '.join(export_formats)))
+      mimetype, extension, needs_arrow = export_formats[format]
+      if needs_arrow and pa is None:
+         api.abort(501, '{f} export needs pyarrow, which is not installed'.format(f=format))
+      headers = {'Content-Disposition': 'attachment; filename=stops.{e}'.format(e=extension)}
+      return Response(export_stops(format), mimetype=mimetype, headers=headers)
 
-      result = {}
-      self = cur.execute('SELECT self FROM stops_table WHERE stop_id = ?',(id,)).fetchone()[0]
-      for p in display:
-         if p != '_links':
-            result[p] = cur.execute('SELECT '+p+ ' FROM stops_table WHERE stop_id = ' +str(id)).fetchone()[0]
-         else:
-            result[p] = {'self':{'href':self},'next':{'href':next},'prev':{'href':prev}}
-      return result, 200
-   
-@api.route('/stops/<int:stop_id>')
-@api.param('stop_id','id of stop (stop_id)')  
-class Stops(Resource):
-   @api.doc(description='retrieve information about a stop in Database from Deutsche Bahn API (use only stop id with default included value)')
+@api.route('/stops/summary')
+class StopsSummary(Resource):
+   @api.doc(description='statistics over every stored stop: counts per area, age of last_updated, most frequent lines and operators of next_departure',
+            params={'bbox': 'min_lat,min_lon,max_lat,max_lon of an area to count, can be repeated. Without it stops are counted per grid cell',
+                    'cell': 'grid cell size in degrees when no bbox is given, default 1',
+                    'top': 'number of lines and operators to return, default 10'})
    @api.response(200, 'OK')
-   @api.response(404, 'Stop Not Found')
    @api.response(400, 'Query Malformed')
-   @api.response(503, 'Service Not Avalaible')
-   def get(self, stop_id):
-      query = str(stop_id)
-      display = ['stop_id','last_updated','name','latitude','longitude','next_departure','_links']
-      if query.isdigit():
-         id = int(query)
-      else:
+   def get(self):
+      try:
+         boxes = np.array([[float(v) for v in b.split(',')] for b in request.args.getlist('bbox')], dtype=float).reshape(-1, 4)
+         cell = float(request.args.get('cell', 1))
+         top = int(request.args.get('top', 10))
+      except ValueError:
          api.abort(400, 'query parameter is malformed')
+      if not cell > 0 or top < 0:
+         api.abort(400, 'cell should be positive and top not negative')
+      started = time.perf_counter()
+      result = summarize_stops(get_db(), boxes, cell, top)
+      record_phase('summary', time.perf_counter() - started)
+      return result, 200
 
-      cur.execute('SELECT * FROM stops_table WHERE stop_id = ?', (id,))
-      selected = cur.fetchone()
+import_model = api.model('StopsImport', {
+    'queries': fields.List(fields.String, example=['query=Berlin Hbf']),
+    'names': fields.List(fields.String, example=['Potsdam Hbf'])
+})
 
-      if selected is None:
-         api.abort(404, 'Stop not found in DB')
-      
-      resp = rq.get('{api_url}stops/{id}/departures?duration=120'.format(api_url=api_url, id = id))
-      data = resp.json()
+@api.route('/stops/import')
+class StopsImport(Resource):
+   @api.doc(description='bulk import stops from Deutsche Bahn API: a json body with queries and/or names, '
+                        'or a text file upload (form field file) with one stop name per line')
+   @api.response(200, 'OK, per item status in items')
+   @api.response(400, 'Request Malformed')
+   @api.expect(import_model)
+   def post(self):
+      queries = []
+      upload = request.files.get('file')
+      if upload is not None:
+         try:
+            text = upload.read().decode('utf-8')
+         except UnicodeDecodeError:
+            return {'message':'The uploaded file should be utf-8 text'}, 400
+         for line in text.splitlines():
+            if line.strip():
+               queries.append(urlencode({'query': line.strip()}))
+      else:
+         body = request.get_json(silent=True)
+         if not isinstance(body, dict):
+            return {'message':'Expected a json body with queries or names, or a file upload'}, 400
+         for key in ('queries', 'names'):
+            if not isinstance(body.get(key, []), list) or not all(isinstance(v, str) for v in body.get(key, [])):
+               return {'message':'{k} should be a list of strings'.format(k=key)}, 400
+         queries.extend(body.get('queries', []))
+         queries.extend(urlencode({'query': n}) for n in body.get('names', []))
 
-      des=[]
+      if not queries or not all(isinstance(q, str) and q for q in queries):
+         return {'message':'Empty or invalid queries in import request'}, 400
+      if len(queries) > import_max_items:
+         return {'message':'Too many queries, at most {n} per import'.format(n=import_max_items)}, 400
 
-      if resp.status_code == 503:
-         api.abort(503, 'Service is not avalaible at the time.')
+      def lookup(query):
+         try:
+            return lookup_locations(query, priority='bulk')
+         except UpstreamUnavailable:
+            return 503, None
 
-      if data['departures'] == []:
-         api.abort(404, 'No departues in next 120 miniutes')
-      else:
-         for d in data['departures']:
-            if d['platform'] and d['direction']:
-               des = d
-               break
-      
-      
-      cur.execute('SELECT DISTINCT self from stops_table WHERE stop_id < ? ORDER BY stop_id DESC',(id,))
-      d = cur.fetchone()
-      if d:
-         prev = d[0]
-      else:
-         prev = None
-      cur.execute('SELECT DISTINCT self from stops_table WHERE stop_id > ? ORDER BY stop_id',(id,))
-      d = cur.fetchone()
-      if d:
-         next = d[0]
-      else:
-         next = None
-      update_query = '''UPDATE stops_table SET last_updated = ?, next_departure = ?, next = ?, prev = ? where stop_id = ?'''
       t = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-      if des != []:
-         next_dep = 'Platform {n} {name} towards {d}'.format(n=des['platform'],name=des['line']['id'],d=des['direction'])
-      else:
-         api.abort(404, 'No departues in next 120 miniutes')
+      items = []
+      rows = {}
+      for query, (status, data) in zip(queries, import_pool.map(lookup, queries)):
+         item_rows = location_rows(data, t) if status == 200 else []
+         if status == 200 and not item_rows:
+            status = 404
+         for r in item_rows:
+            rows[r[0]] = r
+         items.append({'query': query, 'status': status, 'stop_ids': [r[0] for r in item_rows]})
 
-      data_tuple = (t,next_dep,next,prev,id)
-      cur.execute(update_query, data_tuple)
-      con.commit()
+      created = upsert_stops(get_db(), list(rows.values())) if rows else set()
+      for item in items:
+         if item['status'] == 200 and any(id in created for id in item['stop_ids']):
+            item['status'] = 201
 
-      result = {}
-      self = cur.execute('SELECT self FROM stops_table WHERE stop_id = ?',(id,)).fetchone()[0]
-      for p in display:
-         if p != '_links':
-            result[p] = cur.execute('SELECT '+p+ ' FROM stops_table WHERE stop_id = ' +str(id)).fetchone()[0]
-         else:
-            result[p] = {'self':{'href':self},'next':{'href':next},'prev':{'href':prev}}
-      return result, 200
+      return {'imported': len(rows), 'created': len(created), 'items': items}, 200
+   
+@api.route('/stops/<string:include>')
+@api.param('include','include query string in the from of : {stop_id}?inlcude={parameters to be included}')  
+class StopsInclude(Resource):
+   @api.doc(description='retrieve information about a stop in Database from Deutsche Bahn API')
+   @api.response(200, 'OK')
+   @api.response(304, 'Not Modified (If-None-Match)')
+   @api.response(404, 'Stop Not Found')
+   @api.response(400, 'Query Malformed')
+   @api.response(503, 'Service Not Avalaible')
+   def get(self, include):
+      id_part, sep, rest = include.partition('?')
+      if not id_part.isdigit():
+         api.abort(400, 'query is malformed.')
+      if sep and rest[:8] != 'include=':
+         api.abort(400, 'query string word is malformed.')
+      fields = parse_include(rest[8:] if sep else request.args.get('include'))
+      return stop_representation(int(id_part), fields)
+   
+@api.route('/stops/<int:stop_id>')
+@api.param('stop_id','id of stop (stop_id)')  
+class Stops(Resource):
+   @api.doc(description='retrieve information about a stop in Database from Deutsche Bahn API (default included values unless ?include= is given)',
+            params={'include': 'comma separated fields to include, e.g. name,next_departure (optional)'})
+   @api.response(200, 'OK')
+   @api.response(304, 'Not Modified (If-None-Match)')
+   @api.response(404, 'Stop Not Found')
+   @api.response(400, 'Query Malformed')
+   @api.response(503, 'Service Not Avalaible')
+   def get(self, stop_id):
+      fields = parse_include(request.args.get('include'))
+      return stop_representation(stop_id, fields)
    
    @api.doc(description='delete a stop from Database')
    @api.response(200, 'OK')
    @api.response(404, 'Stop Not Found')
    @api.response(400, 'Query Malformed')
    def delete(self,stop_id):
+      db = get_db()
+      cur = db.cursor()
       if stop_id > 0:
          id = stop_id
       else:
@@ -293,7 +2108,8 @@ class Stops(Resource):
          return result,404
       else:
          cur.execute('DELETE FROM stops_table WHERE stop_id = ?', (id,))
-         con.commit()
+         db.commit()
+         stop_responses.clear()
          result = {'message' : ' The stop_id {s_id} was removed from the database.'.format(s_id = str(id)),
                    'stop_id' : id}
          return result,200
@@ -301,113 +2117,38 @@ class Stops(Resource):
    @api.response(404, 'Stop was not found')
    @api.response(400, 'Validation Error')
    @api.response(200, 'OK')
-   @api.expect(stops_model, validate=True)
+   @api.expect(stops_model)
    @api.doc(description="Update a stop by its stop_id in Database")
    def put(self,stop_id):
+      db = get_db()
       id = stop_id
-      cur.execute('SELECT * FROM stops_table WHERE stop_id = ?', (id,))
-      selected = cur.fetchone()
+      selected = fetch_stop(db, id, ('stop_id',))
       if selected is None:
          api.abort(404, "Stop {} doesn't exist".format(id))
 
-      t = ''
-
       stop = request.json
-      if 'stop_id' in stop or 'self' in stop or 'next' in stop or 'prev' in stop:
-         return {'message':'Stop Id, links(self,next,prev) are not permitted parameters and cannot be changed'}, 400
-      
-      if stop == {}:
-         return {'message':'Empty request is invalid'}, 400
-
-      if 'name' in stop:
-         if stop['name'] == '':
-            return {'message':'Empty string in name field is invalid'}, 400
-      if 'next_departure' in stop:
-         if stop['next_departure'] == '':
-            return {'message':'Empty string in next_departure field is invalid'}, 400
-      if 'latitude' in stop:
-         if stop['latitude'] < -90 or stop['latitude'] > 90 :
-            return {'message':'Invalid latitude value'}, 400
-      if 'longitude' in stop:
-         if stop['longitude'] < -180 or stop['longitude'] > 180 :
-            return {'message':'Invalid longitude value'}, 400   
-      if 'last_updated' in stop:
-         t = stop['last_updated']
-         if len(t) != 19:
-            return {'message':'Invalid last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if t[4] != '-' or t[7] != '-' or t[10] != '-' or t[13] != ':' or t[16] != ':':
-            return {'message':'Invalid last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if not t[0:4].isdigit():
-            return {'message':'Invalid last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if not t[5:7].isdigit():
-            return {'message':'Invalid last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if not t[8:10].isdigit():
-            return {'message':'Invalid last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if not t[11:13].isdigit():
-            return {'message':'Invalid last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if not t[14:16].isdigit():
-            return {'message':'Invalid last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if not t[17:].isdigit():
-            return {'message':'Invalid last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         
-         #month check
-         if int(t[5:7]) > 12:
-            return {'message':'Invalid month in last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if int(t[5:7]) > 12:
-            return {'message':'Invalid month in last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         
-         #day check
-         if int(t[8:10]) > 31 and (int(t[5:7]) == 1 or int(t[5:7]) == 3 or int(t[5:7]) == 5 or int(t[5:7]) == 7 or int(t[5:7]) == 8 or int(t[5:7]) == 10 or int(t[5:7]) == 12):
-            return {'message':'Invalid day in last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if int(t[8:10]) > 30 and (int(t[5:7]) == 4 or int(t[5:7]) == 6 or int(t[5:7]) == 9 or int(t[5:7]) == 11):
-            return {'message':'Invalid day in last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if int(t[8:10]) > 28 and int(t[5:7]) == 2 and int(t[0:4])%4 != 0:
-            return {'message':'Invalid day in last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         if int(t[8:10]) > 29 and int(t[5:7]) == 2 and int(t[0:4])%4 == 0:
-            return {'message':'Invalid day in last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         
-         #hour check
-         if int(t[11:13]) > 23:
-            return {'message':'Invalid hour in last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         
-         #minute check
-         if int(t[14:16]) > 59:
-            return {'message':'Invalid minute in last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-         
-         #second check
-         if int(t[17:]) > 59:
-            return {'message':'Invalid second in last_updated time format, please refer to yyyy-mm-dd-hh:mm:ss'}, 400
-      else:
-         t = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-      
-      allowed = ['name','latitude','longitude','last_updated','next_departure']
-      requested = []
-      for req in stop:
-         if req not in allowed:
-            return {'message':'Invalid request format, please refer to stop model'}, 400
-         requested.append(req)
-
-      for r in requested:
-         update_query = 'UPDATE stops_table SET '+r+' = ? where stop_id = ?'
-         data_tuple = (stop[r],id)
-         cur.execute(update_query, data_tuple)
-         con.commit()
-      
-      if 'last_updated' not in stop:
-         update_query = '''UPDATE stops_table SET last_updated = ? where stop_id = ?'''
-         data_t = (t,id)
-         cur.execute(update_query, data_t)
-         con.commit()
+      errors = validate_stop(stop)
+      if errors:
+         return validation_failed(errors)
+
+      t = stop.get('last_updated') or datetime.now().strftime(last_updated_format)
+      values = dict(stop)
+      values['last_updated'] = t
+      if 'next_departure' in values:
+         values['next_operator'] = None
+      with db:
+         update_stop(db, id, values)
+      stop_responses.invalidate([id])
       
       result = {}
-      self = cur.execute('SELECT self FROM stops_table WHERE stop_id = ?',(id,)).fetchone()[0]
       result['stop_id'] = id
       result['last_updated'] = t
-      result['_links'] = {'self':{'href':self}}
+      result['_links'] = {'self':{'href':selected['self']}}
       return result, 200
 
 @api.route('/operator-profiles/<int:stop_id>')
 @api.param('stop_id','id of stop (stop_id)')  
+@api.param('stream','true to receive profiles as json lines while they are generated', _in='query')
 class Profiles(Resource):
    @api.doc(description='retrieve profile information of operators who operate services departing from a stop in DB in the next 90 minutes, (info credit to Gemini API)')
    @api.response(200, 'OK')
@@ -415,6 +2156,8 @@ class Profiles(Resource):
    @api.response(400, 'Query Malformed')
    @api.response(503, 'Service Not Avalaible')
    def get(self, stop_id):
+      db = get_db()
+      cur = db.cursor()
       if stop_id < 0:
          return {'message':'Invalid request format, please enter positive integer'}, 400
 
@@ -424,16 +2167,14 @@ class Profiles(Resource):
       if selected is None:
          api.abort(404, "Stop {} doesn't exist in DB".format(id))
 
-      resp = rq.get('{api_url}stops/{id}/departures?duration=90&results=5'.format(api_url=api_url, id = id))
-      if resp.status_code != 200:
-         if resp.status_code == 404:
+      status, data, age = get_departures(id, 90, 5)
+      if status != 200:
+         if status == 404:
             api.abort(404,'Stop queried does not exist anymore in external DB API.')
-         if resp.status_code == 400:
+         if status == 400:
             api.abort(400, 'query is malformed.')
-         if resp.status_code == 503:
-            api.abort(503, 'Service is not avalaible at the time.')
+         api.abort(503, 'Service is not avalaible at the time.')
 
-      data = resp.json()
       operators = []
 
       if data['departures'] == []:
@@ -443,74 +2184,313 @@ class Profiles(Resource):
             if d['line']['operator']['name'] not in operators:
                operators.append(d['line']['operator']['name'])
 
+      questions = ['Give me some information about {name} in one paragraph'.format(name = op) for op in operators]
+
+      #stream=true sends each profile as a json line as soon as Gemini answers it
+      if request.args.get('stream') == 'true':
+         def generate():
+            for i, response in gemini_answers(questions):
+               yield json.dumps({'stop_id':id,'operator_name':operators[i],'information':response}) + '\n'
+         return Response(generate(), mimetype='application/x-ndjson')
+
+      answers = ask_gemini_all(questions)
+      if all(a is None for a in answers):
+         api.abort(503, 'Gemini service is not avalaible at the time.')
+
       result = {}
       result['stop_id'] = id
       all_info = []
-      for op in operators:
-         question = 'Give me some information about {name} in one paragraph'.format(name = op)
-         response = gemini.generate_content(question).text
+      for op, response in zip(operators, answers):
          all_info.append({'operator_name':op,'information':response})
       
       result['profiles'] = all_info
          
       return result, 200
 
+@api.route('/cache-stats')
+class CacheStats(Resource):
+   @api.doc(description='hit/miss/eviction counters of the in-process caches, used to tune their TTL and size')
+   @api.response(200, 'OK')
+   def get(self):
+      return {'departures': departure_cache.stats(),
+              'stop_responses': stop_responses.stats(),
+              'gemini': gemini_cache.stats(),
+              'guides': guide_cache.stats(),
+              'departure_refresher': refresher.stats()}, 200
+
+@api.route('/gemini-cache')
+class GeminiCacheEntries(Resource):
+   @api.doc(description='invalidate cached Gemini answers, either one prompt or the whole cache',
+            params={'prompt': 'exact prompt to invalidate, e.g. Give me some tour information about Berlin Hbf (optional)'})
+   @api.response(200, 'OK')
+   def delete(self):
+      prompt = request.args.get('prompt')
+      removed = gemini_cache.invalidate(prompt)
+      #guides are made of these answers
+      guide_cache.invalidate()
+      return {'message': '{n} cached answer(s) removed.'.format(n=removed), 'removed': removed}, 200
+
+@api.route('/upstream-stats')
+class UpstreamStats(Resource):
+   @api.doc(description='connection pool, timeout and circuit breaker state of the Deutsche Bahn API client')
+   @api.response(200, 'OK')
+   def get(self):
+      return upstream.stats(), 200
+
+@api.route('/metrics')
+class Metrics(Resource):
+   @api.doc(description='request latency, upstream timing, SQLite query and cache metrics in Prometheus text format. '
+                        'They are kept per process: under serve --workers N each scrape is answered by one worker, '
+                        'named by the pid label of worker_info')
+   @api.response(200, 'OK')
+   def get(self):
+      gauges = [('worker_info', {'pid': str(os.getpid()), 'refresher': str(refresher.owner).lower()}, 1)]
+      for name, stats in (('departures', departure_cache.stats()), ('stop_responses', stop_responses.stats()),
+                          ('gemini', gemini_cache.stats()), ('guides', guide_cache.stats())):
+         gauges.append(('cache_hit_ratio', {'cache': name}, stats['hit_ratio']))
+         gauges.append(('cache_entries', {'cache': name}, stats['size']))
+      return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@api.route('/guide/routes')
+class GuideRoutes(Resource):
+   @api.doc(description='candidate routes between stored stops, found from the stops their next departure heads to: '
+                        'the text after "towards" (the whole next_departure without it) starts with the destination name',
+            params={'limit': 'number of routes to return, default 10'})
+   @api.response(200, 'OK')
+   @api.response(400, 'Query Malformed')
+   def get(self):
+      try:
+         limit = int(request.args.get('limit', 10))
+      except ValueError:
+         api.abort(400, 'query parameter is malformed')
+      if not 0 < limit <= stops_max_page_size:
+         api.abort(400, 'limit should be between 1 and {n}'.format(n=stops_max_page_size))
+
+      result = []
+      for r in guide_routes(get_db(), limit):
+         result.append({'source': {'stop_id': r['source_id'], 'name': r['source'], '_links': {'self': {'href': r['source_self']}}},
+                        'destination': {'stop_id': r['destination_id'], 'name': r['destination'], '_links': {'self': {'href': r['destination_self']}}},
+                        'next_departure': r['departure']})
+      return {'routes': result, 'count': len(result)}, 200
+
 @api.route('/guide')
 class Guide(Resource):
-   @api.doc(description='Provide touring information of stored stops in Database, (info credit to Gemini API)')
+   @api.doc(description='Provide touring information of stored stops in Database, (info credit to Gemini API). '
+                        'It is about the first route of /guide/routes: a stop whose next departure heads towards the name of another stop')
    @api.response(200, 'OK')
    @api.response(400, 'Query Malformed')
    @api.response(503, 'Service Not Avalaible')
    def get(self):
-      query_get_stop_name = 'SELECT name FROM stops_table'
-      query_get_departures = 'SELECT next_departure FROM stops_table'
-      stop_names = cur.execute(query_get_stop_name).fetchall()
-      if len(stop_names) < 2:
+      db = get_db()
+      if db.execute('SELECT COUNT(*) FROM stops_table').fetchone()[0] < 2:
          api.abort(404,'Only one stop in Database')
-      departures = cur.execute(query_get_departures).fetchall()
       source = ''
       destination = ''
-      for nm in stop_names:
-         for depart in departures:
-            if depart[0]:
-               if nm[0] in depart[0]:
-                  destination = nm[0]
-                  source = stop_names[departures.index(depart)][0]
-                  break
+      routes = guide_routes(db, 1)
+      if routes:
+         source = routes[0]['source']
+         destination = routes[0]['destination']
       
-      if source and destination:
-         question_for_source = 'Give me some tour information about {place}'.format(place = source)
-         question_for_destination = 'Give me some tour information about {place}'.format(place = destination)
-         question_for_extra_experience_inbetween = 'Give me more information about touring from {source} to {destination}'.format(source= source ,destination = destination)
+      if not (source and destination):
+         api.abort(404,'No connection between stops in Database')
 
-         source_info = gemini.generate_content(question_for_source).text
-         destination_info = gemini.generate_content(question_for_destination).text
-         extra_info = gemini.generate_content(question_for_extra_experience_inbetween).text
+      headers = {'Content-Disposition': 'attachment; filename={f}'.format(f=txt_file)}
+      cached = guide_cache.get(source, destination)
+      if cached is not None:
+         return Response(cached, mimetype='application/txt', headers=headers)
 
-         file = open(txt_file, 'w')
+      question_for_source = 'Give me some tour information about {place}'.format(place = source)
+      question_for_destination = 'Give me some tour information about {place}'.format(place = destination)
+      question_for_extra_experience_inbetween = 'Give me more information about touring from {source} to {destination}'.format(source= source ,destination = destination)
 
-         file.write(source_info)
-         file.write('\n')
-         file.write(destination_info)
-         file.write('\n')
-         file.write(extra_info)
-         file.close()
+      #the response starts with the first section Gemini answers, a guide without any answer is an error
+      sections = answers_in_order([question_for_source, question_for_destination, question_for_extra_experience_inbetween])
+      ready = []
+      for answer in sections:
+         ready.append(answer)
+         if answer is not None:
+            break
+      if all(a is None for a in ready):
+         api.abort(503, 'Gemini service is not avalaible at the time.')
 
-      else:
-         api.abort(404,'No connection between stops in Database')
+      def generate():
+         answers = []
+         for answer in chain(ready, sections):
+            yield ('\n' if answers else '') + (answer if answer is not None else 'Tour information is not avalaible at the time.')
+            answers.append(answer)
+         #only complete guides are kept
+         if None not in answers:
+            guide_cache.put(source, destination, '\n'.join(answers))
 
-      return send_file(txt_file, mimetype='application/txt', as_attachment=True)
+      return Response(generate(), mimetype='application/txt', headers=headers)
       
 
 
-# Load the environment variables from the .env file
-load_dotenv()
+# Gemini Pro model of this process, created by create_app()
+gemini = None
+
+def configure_gemini():
+   # Configure the API key and create a Gemini Pro model
+   global gemini
+   genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+   gemini = genai.GenerativeModel('gemini-pro')
+
+def create_app(start_refresher=True, workers=None):
+   # builds the Flask app with its own db pool, upstream client and Gemini model,
+   # called once per worker process so nothing is shared across a fork. The upstream
+   # rate limit is split evenly between the `workers` processes, SERVE_WORKERS (1 when unset)
+   # for WSGI servers other than serve
+   global db_pool, upstream
+   if workers is None:
+      workers = int(os.environ.get('SERVE_WORKERS', 1))
+   app = Flask(__name__)
+   api.init_app(app)
+   app.before_request(start_request_timer)
+   app.after_request(record_request)
+   app.teardown_appcontext(release_db)
+
+   db_pool = ConnectionPool(db_file, db_pool_size)
+   init_db()
+   upstream = UpstreamClient(api_url, upstream_rate / workers)
+   configure_gemini()
+   if start_refresher:
+      refresher.start()
+   return app
+
+def warm_up(app):
+   # opens the db connections and builds the swagger spec before the first client request
+   conns = [db_pool.acquire() for _ in range(min(db_pool_size, serve_threads))]
+   for conn in conns:
+      conn.execute('SELECT stop_id FROM stops_table LIMIT 1').fetchall()
+      db_pool.release(conn)
+   for names in (stop_fields, ('stop_id',)):
+      select_stop_sql(names, True)
+      select_stop_sql(names, False)
+   with app.test_client() as client:
+      client.get('/swagger.json')
+
+#serve settings, can be tuned from the .env file or the serve command line
+serve_workers          = int(os.environ.get('SERVE_WORKERS', os.cpu_count() or 1))   # worker processes
+serve_threads          = int(os.environ.get('SERVE_THREADS', 16))                    # request threads per worker
+serve_graceful_timeout = float(os.environ.get('SERVE_GRACEFUL_TIMEOUT', 30))         # seconds given to in-flight requests on shutdown
+
+class PooledWSGIServer(BaseWSGIServer):
+   # werkzeug server that handles connections on a fixed pool of threads instead of one new thread each.
+   # multithread makes werkzeug answer in HTTP/1.1, so streamed bodies (/guide, /stops/export) go out chunked.
+   # werkzeug still closes every connection after its response, there is no keep-alive
+   multithread = True
+
+   def __init__(self, host, port, app, threads, fd=None):
+      self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+      super().__init__(host, port, app, fd=fd)
+
+   def process_request(self, request, client_address):
+      self.executor.submit(self.process_request_thread, request, client_address)
+
+   def process_request_thread(self, request, client_address):
+      try:
+         self.finish_request(request, client_address)
+      except Exception:
+         self.handle_error(request, client_address)
+      finally:
+         self.shutdown_request(request)
 
-# Configure the API key
-genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+def run_worker(host, port, threads, fd=None, start_refresher=True, workers=1):
+   # serves until SIGTERM/SIGINT, then finishes the requests in flight before exiting
+   app = create_app(start_refresher=start_refresher, workers=workers)
+   server = PooledWSGIServer(host, port, app, threads, fd=fd)
+   warm_up(app)
 
-# Create a Gemini Pro model
-gemini = genai.GenerativeModel('gemini-pro')   
+   def stop(signum, frame):
+      threading.Thread(target=server.shutdown, daemon=True).start()
+   signal.signal(signal.SIGTERM, stop)
+   signal.signal(signal.SIGINT, stop)
+
+   logger.info('worker %d serving on %s:%d with %d threads', os.getpid(), host, server.port, threads)
+   try:
+      server.serve_forever()
+   finally:
+      server.executor.shutdown(wait=True)
+      server.server_close()
+      refresher.stop()
+      db_pool.close_all()
+
+def serve(host, port, workers, threads):
+   # pre-fork server: the parent binds the socket once and keeps `workers` children accepting on it,
+   # replacing any that die. Only the first worker runs the departure refresher
+   if workers <= 1 or not hasattr(os, 'fork'):
+      run_worker(host, port, threads)
+      return
+
+   #migrate once here so that the workers don't race each other on it
+   pool = ConnectionPool(db_file, 1)
+   with pool.connection() as conn:
+      migrate(conn)
+   pool.close_all()
+
+   sock = socket.create_server((host, port), backlog=1024)
+   sock.set_inheritable(True)
+   children = {}
+   started = {}
+   stopping = threading.Event()
+
+   def spawn(index):
+      #a worker that dies right after starting is most likely going to do it again
+      if time.monotonic() - started.get(index, 0) < 1:
+         time.sleep(1)
+      started[index] = time.monotonic()
+      pid = os.fork()
+      if pid == 0:
+         signal.signal(signal.SIGTERM, signal.SIG_DFL)
+         signal.signal(signal.SIGINT, signal.SIG_DFL)
+         code = 0
+         try:
+            run_worker(host, port, threads, fd=sock.fileno(), start_refresher=(index == 0), workers=workers)
+         except BaseException:
+            logger.exception('worker %d failed', os.getpid())
+            code = 1
+         finally:
+            os._exit(code)
+      children[pid] = index
+
+   def stop(signum, frame):
+      stopping.set()
+      for pid in list(children):
+         try:
+            os.kill(pid, signal.SIGTERM)
+         except ProcessLookupError:
+            pass
+   signal.signal(signal.SIGTERM, stop)
+   signal.signal(signal.SIGINT, stop)
+
+   logger.info('serving on %s:%d with %d workers x %d threads', host, port, workers, threads)
+   for index in range(workers):
+      spawn(index)
+
+   while children:
+      try:
+         pid, status = os.waitpid(-1, 0)
+      except ChildProcessError:
+         break
+      except InterruptedError:
+         continue
+      index = children.pop(pid, None)
+      if index is not None and not stopping.is_set():
+         logger.warning('worker %d exited with status %d, restarting it', pid, status)
+         spawn(index)
+      if stopping.is_set():
+         break
+
+   deadline = time.monotonic() + serve_graceful_timeout
+   while children and time.monotonic() < deadline:
+      pid, status = os.waitpid(-1, os.WNOHANG)
+      if pid:
+         children.pop(pid, None)
+      else:
+         time.sleep(0.1)
+   for pid in children:
+      os.kill(pid, signal.SIGKILL)
+   sock.close()
 
 if __name__ == "__main__":
    #Here's a quick example of using the Generative AI API:
@@ -519,7 +2499,18 @@ if __name__ == "__main__":
    #print(question)
    #print(response.text)
    #app.run(debug=True)
-   con = sqlite3.connect(db_file, check_same_thread=False)
-   cur = con.cursor()
-   cur.execute('CREATE TABLE IF NOT EXISTS stops_table (stop_id,name,latitude,longitude,last_updated,self,prev,next,next_departure)')
-   app.run()
\ No newline at end of file
+   parser = argparse.ArgumentParser(description='Touring API. Without a command the Flask development server is started.')
+   commands = parser.add_subparsers(dest='command')
+   serve_parser = commands.add_parser('serve', help='multi-process, multi-threaded server for production use')
+   serve_parser.add_argument('--host', default='127.0.0.1')
+   serve_parser.add_argument('--port', type=int, default=5000)
+   serve_parser.add_argument('--workers', type=int, default=serve_workers, help='worker processes (SERVE_WORKERS)')
+   serve_parser.add_argument('--threads', type=int, default=serve_threads, help='request threads per worker (SERVE_THREADS)')
+   args = parser.parse_args()
+
+   if args.command == 'serve':
+      logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s in %(process)d: %(message)s')
+      serve_threads = args.threads
+      serve(args.host, args.port, args.workers, args.threads)
+   else:
+      create_app().run()
@@ -0,0 +1,87 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault('GOOGLE_API_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeResponse:
+   def __init__(self, status_code, body=None, headers=None):
+      self.status_code = status_code
+      self.body = body
+      self.headers = headers or {}
+
+   def json(self):
+      return self.body
+
+
+class FakeUpstream:
+   # stands in for requests.Session.get against v6.db.transport.rest
+   def __init__(self):
+      self.calls = []
+      self.status = 200
+      self.lock = threading.Lock()
+
+   def locations(self, query):
+      return [{'type': 'stop', 'id': str(8011160 + i), 'name': name,
+               'location': {'latitude': 52.5 + i / 100, 'longitude': 13.3 + i / 100}}
+              for i, name in enumerate(['Berlin Hbf', 'Potsdam Hbf', 'Spandau'])]
+
+   def departures(self, id):
+      return {'departures': [
+         {'platform': '3', 'direction': 'Berlin Hbf', 'line': {'id': 're1', 'operator': {'name': 'DB Regio'}}},
+         {'platform': '1', 'direction': 'Spandau', 'line': {'id': 's5', 'operator': {'name': 'S-Bahn Berlin'}}},
+      ]}
+
+   def get(self, url, params=None, timeout=None):
+      with self.lock:
+         self.calls.append(url)
+      if self.status != 200:
+         return FakeResponse(self.status)
+      if '/departures' in url:
+         return FakeResponse(200, self.departures(url.split('stops/')[1].split('/')[0]))
+      return FakeResponse(200, self.locations(url))
+
+
+class FakeGemini:
+   def __init__(self, delay=0.0):
+      self.delay = delay
+
+   def generate_content(self, question, **kwargs):
+      time.sleep(self.delay)
+      class Answer:
+         text = 'answer to ' + question
+      return Answer()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+   monkeypatch.setattr(main, 'db_file', str(tmp_path / 'test.db'))
+   app = main.create_app(start_refresher=False)
+   fake = FakeUpstream()
+   main.upstream.session.get = fake.get
+   main.gemini = FakeGemini()
+   app.fake_upstream = fake
+   yield app
+   main.db_pool.close_all()
+   main.departure_cache.clear()
+   main.stop_responses.clear()
+
+
+@pytest.fixture
+def client(app):
+   return app.test_client()
+
+
+@pytest.fixture
+def stop_ids(client):
+   # the three stops of FakeUpstream.locations, stored through PUT /stops/<query>
+   assert client.put('/stops/query=berlin').status_code in (200, 201)
+   with main.db_pool.connection() as conn:
+      return [r[0] for r in conn.execute('SELECT stop_id FROM stops_table ORDER BY stop_id')]
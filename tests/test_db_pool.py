@@ -0,0 +1,36 @@
+import threading
+
+import pytest
+
+import main
+from conftest import FakeGemini
+
+
+def test_acquire_times_out_when_pool_is_exhausted(tmp_path):
+   pool = main.ConnectionPool(str(tmp_path / 'pool.db'), 1, timeout=0.1)
+   held = pool.acquire()
+   with pytest.raises(main.DatabaseBusy):
+      pool.acquire()
+   pool.release(held)
+   with pool.connection() as conn:
+      assert conn.execute('SELECT 1').fetchone()[0] == 1
+   pool.close_all()
+
+
+def test_gemini_cache_does_not_take_a_second_connection(app, client, stop_ids, monkeypatch):
+   # more concurrent requests than pooled connections, each one also reading and writing the Gemini cache
+   main.db_pool.close_all()
+   monkeypatch.setattr(main, 'db_pool', main.ConnectionPool(main.db_file, 2, timeout=5))
+   main.gemini = FakeGemini(delay=0.05)
+   statuses = []
+
+   def profiles():
+      statuses.append(app.test_client().get('/operator-profiles/{id}'.format(id=stop_ids[0])).status_code)
+
+   threads = [threading.Thread(target=profiles, daemon=True) for _ in range(8)]
+   for t in threads:
+      t.start()
+   for t in threads:
+      t.join(timeout=10)
+   assert not any(t.is_alive() for t in threads)
+   assert statuses == [200] * 8
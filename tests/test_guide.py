@@ -0,0 +1,35 @@
+import main
+
+
+def test_routes_follow_the_next_departure_destination(client, stop_ids):
+   assert client.get('/guide/routes').json['count'] == 0
+   for id in stop_ids:
+      assert client.get('/stops/{id}'.format(id=id)).status_code == 200
+   resp = client.get('/guide/routes')
+   assert resp.status_code == 200
+   routes = sorted((r['source']['name'], r['destination']['name']) for r in resp.json['routes'])
+   assert routes == [('Potsdam Hbf', 'Berlin Hbf'), ('Spandau', 'Berlin Hbf')]
+   assert client.get('/guide/routes?limit=1').json['count'] == 1
+
+
+def test_routes_query_can_stop_at_the_limit(app):
+   with main.db_pool.connection() as conn:
+      plan = ' '.join(r[3] for r in conn.execute('EXPLAIN QUERY PLAN ' + main.guide_routes_sql, (1,)))
+   assert 'TEMP B-TREE' not in plan
+   assert 'stops_next_destination' in plan
+
+
+def test_routes_match_the_destination_name_as_a_whole_word_prefix(app, client, stop_ids):
+   departures = {stop_ids[1]: 'Platform 3 re1 towards Berlin Hbf (tief)',
+                 stop_ids[2]: 'Platform 1 s5 towards Berlin Hbfs'}
+   with main.db_pool.connection() as conn, conn:
+      for id, departure in departures.items():
+         conn.execute('UPDATE stops_table SET next_departure = ? WHERE stop_id = ?', (departure, id))
+   routes = client.get('/guide/routes').json['routes']
+   assert [(r['source']['name'], r['destination']['name']) for r in routes] == [('Potsdam Hbf', 'Berlin Hbf')]
+
+   #a client-written departure without "towards" names its destination as a whole
+   with main.db_pool.connection() as conn, conn:
+      conn.execute("UPDATE stops_table SET next_departure = 'Spandau' WHERE stop_id = ?", (stop_ids[0],))
+   routes = client.get('/guide/routes').json['routes']
+   assert ('Berlin Hbf', 'Spandau') in [(r['source']['name'], r['destination']['name']) for r in routes]
@@ -0,0 +1,52 @@
+import io
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('body', [
+   {'queries': 'query=Berlin'},
+   {'names': 'Berlin'},
+   {'queries': ['query=Berlin', 7]},
+   {'names': [None]},
+   {},
+   ['query=Berlin'],
+])
+def test_malformed_bodies_are_rejected_before_any_lookup(app, client, body):
+   resp = client.post('/stops/import', json=body)
+   assert resp.status_code == 400
+   assert app.fake_upstream.calls == []
+
+
+def test_items_report_their_own_status(app, client):
+   resp = client.post('/stops/import', json={'queries': ['query=Berlin']})
+   assert resp.status_code == 200
+   assert [i['status'] for i in resp.json['items']] == [201]
+   assert resp.json['imported'] == 3 and resp.json['created'] == 3
+
+   #the same stops again: found, but nothing new
+   resp = client.post('/stops/import', json={'names': ['Potsdam']})
+   assert [i['status'] for i in resp.json['items']] == [200]
+   assert resp.json['created'] == 0
+
+   app.fake_upstream.status = 500
+   resp = client.post('/stops/import', json={'names': ['Spandau']})
+   assert resp.status_code == 200
+   assert resp.json['items'] == [{'query': 'query=Spandau', 'status': 500, 'stop_ids': []}]
+
+
+def test_upload_imports_one_stop_name_per_line(app, client):
+   data = {'file': (io.BytesIO('Berlin Hbf\n\n  Potsdam Hbf \n'.encode('utf-8')), 'stops.txt')}
+   resp = client.post('/stops/import', data=data, content_type='multipart/form-data')
+   assert resp.status_code == 200
+   assert [i['query'] for i in resp.json['items']] == ['query=Berlin+Hbf', 'query=Potsdam+Hbf']
+   with main.db_pool.connection() as conn:
+      assert conn.execute('SELECT COUNT(*) FROM stops_table').fetchone()[0] == 3
+
+
+def test_upload_that_is_not_utf8_is_rejected(app, client):
+   data = {'file': (io.BytesIO('Köln Hbf\n'.encode('latin-1')), 'stops.txt')}
+   resp = client.post('/stops/import', data=data, content_type='multipart/form-data')
+   assert resp.status_code == 400
+   assert app.fake_upstream.calls == []
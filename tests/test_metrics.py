@@ -0,0 +1,21 @@
+import main
+
+
+def test_metric_with_its_own_buckets():
+   registry = main.MetricsRegistry()
+   registry.describe('queries', 'statements per request', buckets=(1, 2, 5))
+   for value in (1, 2, 2, 4, 9):
+      registry.observe('queries', value)
+   registry.observe('latency', 0.003)
+   text = registry.render()
+   assert 'queries_bucket{le="1"} 1' in text
+   assert 'queries_bucket{le="2"} 3' in text
+   assert 'queries_bucket{le="5"} 4' in text
+   assert 'queries_bucket{le="+Inf"} 5' in text
+   assert 'latency_bucket{le="0.005"} 1' in text
+
+
+def test_queries_per_request_uses_count_buckets(client, stop_ids):
+   text = client.get('/metrics').get_data(as_text=True)
+   assert 'sqlite_queries_per_request_bucket{endpoint="stops",le="1"}' in text
+   assert 'sqlite_queries_per_request_bucket{endpoint="stops",le="0.001"}' not in text
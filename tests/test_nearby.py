@@ -0,0 +1,28 @@
+import numpy as np
+
+import main
+
+
+def brute_force(rows, lat, lon, k, radius=None):
+   ids = np.array([r[0] for r in rows])
+   dist = main.distances(lat, lon, np.array([r[2] for r in rows]), np.array([r[3] for r in rows]))
+   order = np.argsort(dist, kind='stable')
+   if radius is not None:
+      order = order[dist[order] <= radius]
+   return [int(i) for i in ids[order[:k]]]
+
+
+def test_nearest_stops_match_brute_force(app):
+   rng = np.random.default_rng(7)
+   rows = [(i + 1, 'S{i}'.format(i=i), float(a), float(b), '2024-01-01-00:00:00', 'x')
+           for i, (a, b) in enumerate(zip(rng.uniform(47, 55, 5000), rng.uniform(6, 15, 5000)))]
+   with main.db_pool.connection() as conn, conn:
+      conn.executemany('INSERT INTO stops_table (stop_id,name,latitude,longitude,last_updated,self) VALUES (?,?,?,?,?,?)', rows)
+
+   with main.db_pool.connection() as conn:
+      for lat, lon, k, radius in [(52.5, 13.4, 1, None), (52.5, 13.4, 10, None), (50.1, 8.7, 100, None),
+                                  (48.0, 11.0, 25, None), (60.0, 0.0, 10, None), (51.0, 10.0, 50, 20000.0)]:
+         found = [r['stop_id'] for r, d in main.nearest_stops(conn, lat, lon, k, radius)]
+         assert found == brute_force(rows, lat, lon, k, radius)
+      for lat, lon in rng.uniform((47, 6), (55, 15), size=(50, 2)):
+         assert len(main.nearest_stops(conn, lat, lon, 10)) == 10
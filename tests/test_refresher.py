@@ -0,0 +1,40 @@
+import main
+
+
+def test_requests_seen_by_any_worker_order_the_refresh(app, stop_ids, monkeypatch):
+   monkeypatch.setattr(main, 'departure_touch_flush', 0.0)
+   #one refresher per worker process, only the last one runs refresh rounds
+   serving, refreshing = main.DepartureRefresher(True), main.DepartureRefresher(True)
+   serving.touch(stop_ids[2])
+   serving.touch(stop_ids[1])
+   assert refreshing.prioritized_ids() == [stop_ids[1], stop_ids[2], stop_ids[0]]
+
+
+def test_refresh_order_is_read_from_the_index(app):
+   with main.db_pool.connection() as conn:
+      plan = ' '.join(r[3] for r in conn.execute('EXPLAIN QUERY PLAN SELECT stop_id FROM stops_table ORDER BY last_requested DESC, departure_refreshed'))
+   assert 'stops_refresh_order' in plan and 'TEMP B-TREE' not in plan
+
+
+def test_metrics_name_the_worker(client):
+   text = client.get('/metrics').get_data(as_text=True)
+   assert 'worker_info{{pid="{p}",refresher="false"}} 1'.format(p=main.os.getpid()) in text
+
+
+def test_one_process_runs_the_refresher(app):
+   first, second = main.DepartureRefresher(True), main.DepartureRefresher(True)
+   assert first.claim()
+   assert not second.claim()
+   first.lock_file.close()
+   assert second.claim()
+   second.lock_file.close()
+
+
+def test_create_app_splits_the_upstream_rate(tmp_path, monkeypatch):
+   monkeypatch.setattr(main, 'db_file', str(tmp_path / 'test.db'))
+   monkeypatch.setenv('SERVE_WORKERS', '4')
+   main.create_app(start_refresher=False)
+   try:
+      assert main.upstream.limiter.rate == main.upstream_rate / 4
+   finally:
+      main.db_pool.close_all()
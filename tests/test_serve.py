@@ -0,0 +1,23 @@
+import http.client
+import threading
+
+import main
+
+
+def test_pooled_server_streams_chunked_over_http11(app, stop_ids):
+   server = main.PooledWSGIServer('127.0.0.1', 0, app, threads=2)
+   assert server.multithread
+   thread = threading.Thread(target=server.serve_forever, daemon=True)
+   thread.start()
+   try:
+      conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+      conn.request('GET', '/stops/export')
+      resp = conn.getresponse()
+      assert resp.version == 11
+      assert resp.getheader('Transfer-Encoding') == 'chunked'
+      assert len(resp.read().decode().splitlines()) == 1 + len(stop_ids)
+      conn.close()
+   finally:
+      server.shutdown()
+      server.executor.shutdown(wait=True)
+      server.server_close()
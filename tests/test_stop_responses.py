@@ -0,0 +1,57 @@
+import sqlite3
+
+import main
+
+
+def other_worker(app):
+   # a connection of its own, like the one of another serve worker process
+   return sqlite3.connect(main.db_file)
+
+
+def test_cached_body_follows_writes_of_another_process(app, client, stop_ids):
+   id = stop_ids[0]
+   first = client.get('/stops/{id}'.format(id=id))
+   assert first.status_code == 200
+   assert client.get('/stops/{id}'.format(id=id), headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+   hits = main.stop_responses.stats()['hits']
+
+   with other_worker(app) as conn:
+      conn.execute("UPDATE stops_table SET name = 'Renamed' WHERE stop_id = ?", (id,))
+   resp = client.get('/stops/{id}'.format(id=id), headers={'If-None-Match': first.headers['ETag']})
+   assert resp.status_code == 200
+   assert resp.json['name'] == 'Renamed'
+   assert resp.headers['ETag'] != first.headers['ETag']
+   assert main.stop_responses.stats()['hits'] == hits
+
+
+def test_neighbour_links_follow_deletes_of_another_process(app, client, stop_ids):
+   first = client.get('/stops/{id}'.format(id=stop_ids[0]))
+   assert first.json['_links']['next']['href'].endswith(str(stop_ids[1]))
+
+   with other_worker(app) as conn:
+      conn.execute('DELETE FROM stops_table WHERE stop_id = ?', (stop_ids[1],))
+   resp = client.get('/stops/{id}'.format(id=stop_ids[0]))
+   assert resp.json['_links']['next']['href'].endswith(str(stop_ids[2]))
+   assert client.get('/stops/{id}'.format(id=stop_ids[1])).status_code == 404
+
+
+def test_metrics_report_every_cache(client):
+   text = client.get('/metrics').get_data(as_text=True)
+   for name in ('departures', 'stop_responses', 'gemini', 'guides'):
+      assert 'cache_entries{{cache="{n}"}}'.format(n=name) in text
+
+
+def test_write_during_the_departures_call_is_not_cached_over(app, client, stop_ids, monkeypatch):
+   id = stop_ids[0]
+   departures = app.fake_upstream.departures
+
+   def renamed_meanwhile(stop):
+      with other_worker(app) as conn:
+         conn.execute("UPDATE stops_table SET name = 'Renamed' WHERE stop_id = ?", (id,))
+      return departures(stop)
+   monkeypatch.setattr(app.fake_upstream, 'departures', renamed_meanwhile)
+
+   assert client.get('/stops/{id}'.format(id=id)).json['name'] == 'Berlin Hbf'
+   assert main.stop_responses.stats()['size'] == 0
+   monkeypatch.setattr(app.fake_upstream, 'departures', departures)
+   assert client.get('/stops/{id}'.format(id=id)).json['name'] == 'Renamed'
@@ -0,0 +1,38 @@
+import main
+
+
+def test_summary_of_an_empty_table(client):
+   resp = client.get('/stops/summary')
+   assert resp.status_code == 200
+   assert resp.json['stops'] == 0
+   assert resp.json['areas'] == []
+   assert resp.json['lines'] == [] and resp.json['operators'] == []
+   assert resp.json['staleness']['unknown'] == 0
+
+
+def test_summary_before_any_departure_is_known(client, stop_ids):
+   resp = client.get('/stops/summary')
+   assert resp.status_code == 200
+   assert resp.json['stops'] == 3
+   assert resp.json['lines'] == [] and resp.json['operators'] == []
+   assert sum(resp.json['staleness']['stops'].values()) == 3
+
+
+def test_summary_counts_lines_operators_and_boxes(client, stop_ids):
+   for id in stop_ids:
+      assert client.get('/stops/{id}'.format(id=id)).status_code == 200
+   resp = client.get('/stops/summary?bbox=52.5,13.3,52.505,13.305&bbox=0,0,1,1')
+   assert resp.status_code == 200
+   assert resp.json['lines'] == [{'line': 're1', 'stops': 3}]
+   assert resp.json['operators'] == [{'operator': 'DB Regio', 'stops': 3}]
+   assert [a['stops'] for a in resp.json['areas']] == [1, 0]
+   assert resp.json['staleness']['stops']['<1m'] == 3
+
+
+def test_export_csv_streams_every_stop(client, stop_ids, monkeypatch):
+   monkeypatch.setattr(main, 'export_chunk_size', 2)
+   resp = client.get('/stops/export')
+   assert resp.status_code == 200
+   lines = resp.data.decode().splitlines()
+   assert lines[0].startswith('stop_id,name,')
+   assert len(lines) == 1 + len(stop_ids)
@@ -0,0 +1,50 @@
+import pytest
+
+import main
+from conftest import FakeResponse
+
+
+def test_throttled_call_does_not_leave_the_breaker_half_open(app, monkeypatch):
+   monkeypatch.setattr(main, 'upstream_backoff', 0.0)
+   client = main.UpstreamClient('http://upstream.test/')
+   client.breaker = main.CircuitBreaker(threshold=1, cooldown=0)
+   client.session.get = lambda url, params=None, timeout=None: FakeResponse(503)
+   client.get('stops/1/departures')
+   assert client.breaker.state == 'open'
+
+   #cooldown passed, but the request budget is used up
+   client.limiter = main.TokenBucket(0.001, 0, {'interactive': 0.0})
+   with pytest.raises(main.UpstreamThrottled):
+      client.get('stops/1/departures')
+
+   client.limiter = main.TokenBucket(100, 10, {'interactive': 1.0})
+   client.session.get = lambda url, params=None, timeout=None: FakeResponse(200, {'departures': []})
+   assert client.get('stops/1/departures').status_code == 200
+   assert client.breaker.state == 'closed'
+
+
+def test_every_retry_takes_a_token(app, monkeypatch):
+   monkeypatch.setattr(main, 'upstream_backoff', 0.0)
+   monkeypatch.setattr(main, 'upstream_retries', 2)
+   client = main.UpstreamClient('http://upstream.test/')
+   client.limiter = main.TokenBucket(0.001, 2, {'interactive': 0.0})
+   calls = []
+   def overloaded(url, params=None, timeout=None):
+      calls.append(url)
+      return FakeResponse(503)
+   client.session.get = overloaded
+
+   #two tokens: the first attempt and one retry, the second retry finds the budget used up
+   assert client.get('stops/1/departures').status_code == 503
+   assert len(calls) == 2
+   assert client.limiter.stats()['granted']['interactive'] == 2
+
+
+def test_higher_priority_waiter_takes_the_next_token():
+   bucket = main.TokenBucket(1000, 1, {'interactive': 1.0, 'bulk': 1.0})
+   assert bucket.acquire('bulk')
+   bucket.waiting['interactive'] = 1
+   bucket.waits['bulk'] = 0.05
+   assert not bucket.acquire('bulk')
+   bucket.waiting['interactive'] = 0
+   assert bucket.acquire('interactive')
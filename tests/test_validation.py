@@ -0,0 +1,74 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('value, valid', [
+   ('2024-02-29-12:00:00', True),
+   ('2000-02-29-00:00:00', True),
+   ('1900-02-29-12:00:00', False),
+   ('2023-02-29-12:00:00', False),
+   ('2024-04-31-12:00:00', False),
+   ('2024-01-01-24:00:00', False),
+   ('2024-1-01-12:00:00', False),
+   (20240101, False),
+])
+def test_last_updated_follows_the_calendar(value, valid):
+   assert (main.check_last_updated(value) is None) == valid
+
+
+def test_every_error_of_a_payload_comes_back(client, stop_ids):
+   resp = client.put('/stops/{id}'.format(id=stop_ids[0]),
+                     json={'name': '', 'latitude': 91, 'longitude': 'east', 'last_updated': '1900-02-29-12:00:00', 'self': 'x'})
+   assert resp.status_code == 400
+   assert set(resp.json['errors']) == {'name', 'latitude', 'longitude', 'last_updated', 'self'}
+   assert resp.json['message'] == '5 validation errors'
+
+
+def test_single_error_is_the_message(client, stop_ids):
+   resp = client.put('/stops/{id}'.format(id=stop_ids[0]), json={'latitude': True})
+   assert resp.status_code == 400
+   assert resp.json['message'] == 'latitude should be a number'
+
+
+def names(stop_ids):
+   with main.db_pool.connection() as conn:
+      return [conn.execute('SELECT name FROM stops_table WHERE stop_id = ?', (id,)).fetchone()[0] for id in stop_ids]
+
+
+def test_patch_with_an_invalid_stop_writes_nothing(client, stop_ids):
+   before = names(stop_ids)
+   resp = client.patch('/stops', json={'stops': [{'stop_id': stop_ids[0], 'name': 'Renamed'},
+                                                 {'stop_id': stop_ids[1], 'latitude': 100},
+                                                 {'stop_id': stop_ids[0], 'name': 'Twice'}]})
+   assert resp.status_code == 400
+   assert set(resp.json['errors']) == {'1', '2'}
+   assert names(stop_ids) == before
+
+
+def test_patch_with_a_missing_stop_writes_nothing(client, stop_ids):
+   before = names(stop_ids)
+   resp = client.patch('/stops', json={'stops': [{'stop_id': stop_ids[0], 'name': 'Renamed'},
+                                                 {'stop_id': 1, 'name': 'Nowhere'}]})
+   assert resp.status_code == 404
+   assert resp.json['missing'] == [1]
+   assert names(stop_ids) == before
+
+
+def test_patch_failing_midway_rolls_back_the_earlier_updates(client, stop_ids):
+   before = names(stop_ids)
+   with main.db_pool.connection() as conn:
+      conn.execute("CREATE TRIGGER fail_update BEFORE UPDATE ON stops_table WHEN new.stop_id = {id} "
+                   "BEGIN SELECT RAISE(ABORT, 'update failed'); END".format(id=stop_ids[1]))
+   #two field sets, so two statements: the first one succeeds before the second fails
+   resp = client.patch('/stops', json={'stops': [{'stop_id': stop_ids[0], 'name': 'Renamed'},
+                                                 {'stop_id': stop_ids[1], 'latitude': 1.0}]})
+   assert resp.status_code == 500
+   assert names(stop_ids) == before
+
+
+def test_patch_updates_every_stop(client, stop_ids):
+   resp = client.patch('/stops', json={'stops': [{'stop_id': id, 'name': 'Stop {n}'.format(n=n)} for n, id in enumerate(stop_ids)]})
+   assert resp.status_code == 200
+   assert resp.json['updated'] == 3
+   assert names(stop_ids) == ['Stop 0', 'Stop 1', 'Stop 2']